@@ -0,0 +1,198 @@
+from abc import ABC, abstractmethod
+import json
+import logging
+import os
+import time
+from typing import Optional
+import pyarrow
+import pyarrow.parquet as pq
+
+# Layout of an exported answer, following the sci_annot output format
+ANSWER_SCHEMA = pyarrow.schema([
+    ('page_id', pyarrow.string()),
+    ('status', pyarrow.string()),
+    ('worker_id', pyarrow.string()),
+    ('canvasWidth', pyarrow.int64()),
+    ('canvasHeight', pyarrow.int64()),
+    ('annotations', pyarrow.list_(pyarrow.struct([
+        ('id', pyarrow.string()),
+        ('type', pyarrow.string()),
+        ('@context', pyarrow.string()),
+        ('body', pyarrow.list_(pyarrow.struct([
+            ('type', pyarrow.string()),
+            ('purpose', pyarrow.string()),
+            ('value', pyarrow.string()),
+        ]))),
+        ('target', pyarrow.struct([
+            ('source', pyarrow.string()),
+            ('selector', pyarrow.struct([
+                ('type', pyarrow.string()),
+                ('conformsTo', pyarrow.string()),
+                ('value', pyarrow.string()),
+            ])),
+        ])),
+    ]))),
+    # Other fields of the answer, e.g. secondCounter, as a JSON object
+    ('extra', pyarrow.string()),
+])
+
+# Fields of the answer which have their own column in ANSWER_SCHEMA
+ANSWER_COLUMNS = ('canvasWidth', 'canvasHeight', 'annotations')
+
+MANIFEST_SCHEMA = pyarrow.schema([
+    ('page_id', pyarrow.string()),
+    ('offset', pyarrow.int64()),
+])
+
+def make_answer_record(page_id: str, status: str, worker_id: str, answer: dict) -> dict:
+    """Returns a record with ANSWER_SCHEMA. Fields of the answer without their own column are kept in extra.
+    """
+    return {
+        'page_id': page_id,
+        'status': status,
+        'worker_id': worker_id,
+        'canvasWidth': int(answer['canvasWidth']),
+        'canvasHeight': int(answer['canvasHeight']),
+        'annotations': answer['annotations'],
+        'extra': json.dumps({field: value for field, value in answer.items() if field not in ANSWER_COLUMNS})
+    }
+
+class ShardWriter(ABC):
+    """Writes answer records into shards of roughly max_bytes each.
+
+    A shard is written to a temporary file, and renamed once it is full or the writer is closed.
+    Next to every shard, a manifest maps the page IDs in it to their offsets, see MANIFEST_SCHEMA.
+    Summary rows of (page ID, status, worker ID, shard, offset) are only returned for finished shards,
+    so that everything in the export summary has been written completely.
+    """
+    extension = ''
+    # Number of records after which the shard size is checked, None for all records of a call to write
+    records_per_check: Optional[int] = None
+
+    def __init__(self, shard_dir: str, max_bytes: int):
+        """
+        Args:
+            shard_dir (str): Directory of the shards.
+            max_bytes (int): Size after which a new shard is started.
+        """
+        self.shard_dir = shard_dir
+        self.max_bytes = max_bytes
+        # Shards of different runs must not overwrite each other
+        self.run_id = time.time_ns()
+        self.nr_shards = 0
+        self.shard_name: Optional[str] = None
+        self.shard_rows: list[tuple[str, str, str, str, int]] = []
+        os.makedirs(shard_dir, exist_ok=True)
+        for file in os.listdir(shard_dir):
+            if file.endswith('.tmp'):
+                logging.debug(f'Removing unfinished shard {file}')
+                os.remove(os.path.join(shard_dir, file))
+
+    def write(self, records: list[dict]) -> list[tuple[str, str, str, str, int]]:
+        """Writes answer records (see make_answer_record) and returns the summary rows of the shards finished meanwhile.
+        """
+        finished_rows = []
+        step = self.records_per_check or max(1, len(records))
+        for i in range(0, len(records), step):
+            if self.shard_name is None:
+                self.shard_name = f'answers-{self.run_id}-{self.nr_shards:05d}{self.extension}'
+                self._open(self.__path(self.shard_name) + '.tmp')
+            offsets = self._write(records[i:i+step])
+            self.shard_rows.extend(
+                (record['page_id'], record['status'], record['worker_id'], self.shard_name, offset)
+                for record, offset in zip(records[i:i+step], offsets)
+            )
+            if self._size() >= self.max_bytes:
+                finished_rows.extend(self.__finish_shard())
+        return finished_rows
+
+    def close(self) -> list[tuple[str, str, str, str, int]]:
+        """Finishes the current shard and returns its summary rows.
+        """
+        if self.shard_name is None:
+            return []
+        return self.__finish_shard()
+
+    def __finish_shard(self) -> list[tuple[str, str, str, str, int]]:
+        self._close()
+        pq.write_table(pyarrow.Table.from_pylist(
+            [{'page_id': row[0], 'offset': row[4]} for row in self.shard_rows],
+            schema=MANIFEST_SCHEMA
+        ), self.__path(self.shard_name + '.manifest.parquet'))
+        os.replace(self.__path(self.shard_name) + '.tmp', self.__path(self.shard_name))
+        logging.debug(f'Finished shard {self.shard_name} with {len(self.shard_rows)} answer(s)')
+
+        rows = self.shard_rows
+        self.shard_rows = []
+        self.shard_name = None
+        self.nr_shards += 1
+        return rows
+
+    def __path(self, file: str) -> str:
+        return os.path.join(self.shard_dir, file)
+
+    @abstractmethod
+    def _open(self, path: str):
+        pass
+
+    @abstractmethod
+    def _write(self, records: list[dict]) -> list[int]:
+        """Appends records to the current shard and returns their offsets."""
+
+    @abstractmethod
+    def _size(self) -> int:
+        pass
+
+    @abstractmethod
+    def _close(self):
+        pass
+
+class JsonLinesShardWriter(ShardWriter):
+    """Writes one compact JSON object per line. Offsets are byte offsets of the lines.
+    """
+    extension = '.jsonl'
+    records_per_check = 1
+
+    def _open(self, path: str):
+        self.file = open(path, 'wb')
+
+    def _write(self, records: list[dict]) -> list[int]:
+        offsets = []
+        for record in records:
+            offsets.append(self.file.tell())
+            self.file.write(json.dumps(record, separators=(',', ':')).encode() + b'\n')
+        return offsets
+
+    def _size(self) -> int:
+        return self.file.tell()
+
+    def _close(self):
+        self.file.close()
+
+class ParquetShardWriter(ShardWriter):
+    """Writes records with ANSWER_SCHEMA, one row group per call to write. Offsets are row numbers in the shard.
+    """
+    extension = '.parquet'
+
+    def _open(self, path: str):
+        self.sink = pyarrow.OSFile(path, 'wb')
+        self.writer = pq.ParquetWriter(self.sink, ANSWER_SCHEMA)
+        self.nr_rows = 0
+
+    def _write(self, records: list[dict]) -> list[int]:
+        self.writer.write_table(pyarrow.Table.from_pylist(records, schema=ANSWER_SCHEMA))
+        offsets = list(range(self.nr_rows, self.nr_rows + len(records)))
+        self.nr_rows += len(records)
+        return offsets
+
+    def _size(self) -> int:
+        return self.sink.tell()
+
+    def _close(self):
+        self.writer.close()
+        self.sink.close()
+
+SHARD_WRITERS: dict[str, type[ShardWriter]] = {
+    'jsonl': JsonLinesShardWriter,
+    'parquet': ParquetShardWriter,
+}
@@ -0,0 +1,70 @@
+from collections import OrderedDict
+import logging
+import threading
+from typing import Any, Callable, Hashable
+
+class ByteLRUCache:
+    """Thread-safe least-recently-used cache which is bounded by the total size of its values in bytes.
+    Hits and misses are counted and reported in the debug logs.
+    """
+
+    def __init__(self, name: str, max_bytes: int, sizeof: Callable[[Any], int] = len):
+        """
+        Args:
+            name (str): Name of the cache used in log messages.
+            max_bytes (int): Upper bound for the sum of the sizes of all cached values. 0 disables the cache.
+            sizeof (Callable[[Any], int], optional): Returns the size of a value in bytes. Defaults to len.
+        """
+        self.name = name
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.hits = 0
+        self.misses = 0
+        self.size = 0
+        self.__entries: OrderedDict[Hashable, Any] = OrderedDict()
+        self.__lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Any:
+        """Returns the cached value, or None if the key is not cached.
+        """
+        with self.__lock:
+            if key in self.__entries:
+                self.__entries.move_to_end(key)
+                self.hits += 1
+                value = self.__entries[key]
+            else:
+                self.misses += 1
+                value = None
+            logging.debug(f'{self.name} cache {"hit" if value is not None else "miss"} for {key} '
+                f'({self.hits} hits, {self.misses} misses, {len(self.__entries)} entries, {self.size}/{self.max_bytes} bytes)')
+            return value
+
+    def put(self, key: Hashable, value: Any):
+        """Caches a value and evicts the least recently used ones until the cache fits into max_bytes.
+        Values larger than max_bytes are not cached.
+        """
+        value_size = self.sizeof(value)
+        if value_size > self.max_bytes:
+            return
+        with self.__lock:
+            if key in self.__entries:
+                self.size -= self.sizeof(self.__entries.pop(key))
+            self.__entries[key] = value
+            self.size += value_size
+            while self.size > self.max_bytes:
+                _, evicted = self.__entries.popitem(last=False)
+                self.size -= self.sizeof(evicted)
+
+    def get_or_load(self, key: Hashable, loader: Callable[[], Any]) -> Any:
+        """Returns the cached value, or loads, caches and returns it if it's not cached.
+        """
+        value = self.get(key)
+        if value is None:
+            value = loader()
+            self.put(key, value)
+        return value
+
+    def clear(self):
+        with self.__lock:
+            self.__entries.clear()
+            self.size = 0
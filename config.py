@@ -11,6 +11,10 @@ class Config:
     def get(name):
         return Config.__conf[name]
 
+    @staticmethod
+    def get_or_default(name, default):
+        return Config.__conf.get(name, default)
+
     @staticmethod
     def set(name, value):
         Config.__conf[name] = value
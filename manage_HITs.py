@@ -1,10 +1,15 @@
 from collections import Counter
 import logging
-from typing import cast, Optional
+from typing import cast, NamedTuple, Optional
 import coloredlogs
 import argparse
+import contextlib
+import functools
 import os
+import tempfile
 import json
+import time
+from datetime import datetime
 from sci_annot_eval.common.bounding_box import AbsoluteBoundingBox
 from sci_annot_eval.exporters import sci_annot_exporter
 answer_exporter = sci_annot_exporter.SciAnnotExporter()
@@ -13,6 +18,14 @@ from config import Config
 
 args = argparse.Namespace()
 
+def positive_int(value: str) -> int:
+    """argparse type for counts such as --workers, which must be at least 1.
+    """
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f'must be at least 1, got {number}')
+    return number
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser('Amazon MTurk HIT client')
     subparsers = parser.add_subparsers(dest='command')
@@ -30,6 +43,7 @@ if __name__ == '__main__':
     publish_random_parser.add_argument('--minimum-qual-points', '-m', help='The minimum number of qual. points that a turker needs in order to work on these HITs. (default is no requirement)', type=int, default=0)
     publish_random_parser.add_argument('--maximum-qual-points', help='The maximum number of qual. points that a turker needs in order to work on these HITs. (default is no requirement)', type=int, default=0)
     publish_random_parser.add_argument('--require-qualification-done', '-q', help='Indicates that turkers need to have done at least one qualification to work on these HITs.', action='store_true', default=False)
+    publish_random_parser.add_argument('--workers', '-w', help='Number of HITs created concurrently (default is 1)', type=positive_int, default=1)
 
     publish_specific_parser = subparsers.add_parser(
         'publish-specific',
@@ -41,6 +55,7 @@ if __name__ == '__main__':
     publish_specific_parser.add_argument('--minimum-qual-points', '-m', help='The minimum number of qual. points that a turker needs in order to work on these HITs. (default is 0)', type=int, default=0)
     publish_specific_parser.add_argument('--maximum-qual-points', help='The maximum number of qual. points that a turker needs in order to work on these HITs. (default is no requirement)', type=int, default=0)
     publish_specific_parser.add_argument('--require-qualification-done', '-q', help='Indicates that turkers need to have done at least one qualification to work on these HITs.', action='store_true', default=False)
+    publish_specific_parser.add_argument('--workers', '-w', help='Number of HITs created concurrently (default is 1)', type=positive_int, default=1)
 
     mark_for_qualification_parser = subparsers.add_parser(
         'mark-pages-for-qualification',
@@ -55,6 +70,7 @@ if __name__ == '__main__':
         argument_default=argparse.SUPPRESS
     )
     publish_qualification_pages_parser.add_argument('--max-assignments', '-a', help='Max. number of turkers that can do one HIT (default is 10)', type=int, default=10)
+    publish_qualification_pages_parser.add_argument('--workers', '-w', help='Number of HITs created concurrently (default is 1)', type=positive_int, default=1)
 
     create_qual_types_parser = subparsers.add_parser(
         'create-qual-types',
@@ -70,11 +86,17 @@ if __name__ == '__main__':
         'fetch-results',
         description='Fetch results of published HITs'
     )
+    fetch_results_parser.add_argument('--workers', '-w', help='Number of HITs polled concurrently (default is 1)', type=positive_int, default=1)
+    fetch_results_parser.add_argument('--batch-size', '-b', help='Number of fetched pages saved to the DB at once (default is 100)', type=positive_int, default=100)
+    fetch_results_parser.add_argument('--list-reviewable', '-l', help='List reviewable HITs instead of polling the HIT of every submitted page', action='store_true')
+    fetch_results_parser.add_argument('--active-hit-type-only', help='With --list-reviewable, only list HITs of the active HIT type', action='store_true')
 
     eval_retrieved_parser = subparsers.add_parser(
         'eval-retrieved',
         description='Check inter-annotator agreement of retrieved annotations'
     )
+    eval_retrieved_parser.add_argument('--workers', '-w', help='Number of worker processes used for evaluation (default is 1)', type=positive_int, default=1)
+    eval_retrieved_parser.add_argument('--chunk-size', help='Number of pages sent to a worker process at once (default is 16)', type=positive_int, default=16)
 
     ingest_parser = subparsers.add_parser(
         'ingest',
@@ -82,6 +104,9 @@ if __name__ == '__main__':
         argument_default=argparse.SUPPRESS
     )
     ingest_parser.add_argument('parquet_file', metavar='PATH', help='Parquet file with pdf info')
+    ingest_parser.add_argument('--batch-size', '-b', help='Number of PDFs read from the parquet file at once (default is 10000)', type=positive_int, default=10000)
+    ingest_parser.add_argument('--upsert', '-u', help='Skip existing documents and resume from the last checkpoint of this file', action='store_true', default=False)
+    ingest_parser.add_argument('--restart', help='With --upsert, ignore the checkpoint and start from the beginning', action='store_true', default=False)
 
     create_hit_type_parser = subparsers.add_parser(
         'create-hit-type',
@@ -91,11 +116,22 @@ if __name__ == '__main__':
 
     export_answers_parser = subparsers.add_parser(
         'export-answers',
-        description='Save answers to individual json files and additionally save a summary.',
+        description='Save answers to individual json files or to jsonl/parquet shards, and additionally save a summary.',
         argument_default=argparse.SUPPRESS
     )
     export_answers_parser.add_argument('output_dir', metavar='PATH', help='Output directory')
     export_answers_parser.add_argument('--crop-whitespace', '-c', action='store_true', help='Crop whitespace around bounding boxes')
+    export_answers_parser.add_argument('--workers', '-w', help='Number of worker processes (default is the number of CPUs)', type=positive_int, default=os.cpu_count())
+    export_answers_parser.add_argument('--batch-size', '-b', help='Number of pages fetched and summarized at once (default is 1000)', type=positive_int, default=1000)
+    export_answers_parser.add_argument('--format', '-f', help='json saves one file per page, jsonl and parquet save size-bounded shards (default is json)', choices=['json', 'jsonl', 'parquet'], default='json')
+    export_answers_parser.add_argument('--shard-max-bytes', help='Size after which a new jsonl or parquet shard is started (default is 256MiB)', type=positive_int, default=256 * 1024**2)
+
+    mark_exported_parser = subparsers.add_parser(
+        'mark-exported',
+        description='Mark the pages in an existing export summary as exported, which is needed once for summaries '
+            'saved before pages were marked, so that export-answers only exports new and changed pages into them'
+    )
+    mark_exported_parser.add_argument('output_dir', metavar='PATH', help='Output directory of export-answers')
 
     compare_assignments_parser = subparsers.add_parser(
         'compare-assignments',
@@ -114,6 +150,7 @@ if __name__ == '__main__':
     notify_specific_workers_parser.add_argument('worker_ids', metavar='IDs', nargs='+', help='Space-separated list of worker IDs to notify')
     notify_specific_workers_parser.add_argument('subject', metavar='SUBJECT', help='Subject of the email')
     notify_specific_workers_parser.add_argument('message_text', metavar='TEXT', help='Body of the email')
+    notify_specific_workers_parser.add_argument('--campaign-id', help='Resume this campaign: workers already notified in it are skipped (default is a new campaign, whose ID is logged)')
 
     notify_workers_in_range_parser = subparsers.add_parser(
         'notify-workers-in-range',
@@ -124,6 +161,53 @@ if __name__ == '__main__':
     notify_workers_in_range_parser.add_argument('message_text', metavar='TEXT', help='Body of the email')
     notify_workers_in_range_parser.add_argument('--minimum-qual-points', '-m', help='The minimum number of qual. points that a turker needs in order to work on these HITs.', type=int)
     notify_workers_in_range_parser.add_argument('--maximum-qual-points', help='The maximum number of qual. points that a turker needs in order to work on these HITs.', type=int)
+    notify_workers_in_range_parser.add_argument('--campaign-id', help='Resume this campaign: workers already notified in it are skipped (default is a new campaign, whose ID is logged)')
+
+    prefetch_images_parser = subparsers.add_parser(
+        'prefetch-images',
+        description='Download missing page images from image_url_base into image_folder ahead of time',
+        argument_default=argparse.SUPPRESS
+    )
+    prefetch_images_source = prefetch_images_parser.add_mutually_exclusive_group(required=True)
+    prefetch_images_source.add_argument('--ids', metavar='IDs', nargs='+', help='Space-separated list of Page IDs')
+    prefetch_images_source.add_argument('--statuses', '-s', metavar='STATUS', nargs='+', help='Space-separated list of page statuses, e.g. RETRIEVED REVIEWED VERIFIED')
+    prefetch_images_parser.add_argument('--workers', '-w', help='Number of concurrent downloads (default is 8)', type=positive_int, default=8)
+
+    ensure_indexes_parser = subparsers.add_parser(
+        'ensure-indexes',
+        description='Create the DB indexes the queries rely on, and report queries which would still scan a whole collection'
+    )
+
+    sync_quals_parser = subparsers.add_parser(
+        'sync-quals',
+        description='Push the qualification scores of workers that changed since the last push to MTurk, e.g. after an interrupted eval-retrieved'
+    )
+    sync_quals_parser.add_argument('--all', '-a', help='Diff every worker instead of only those with unpushed changes', action='store_true')
+    sync_quals_parser.add_argument('--workers', '-w', help='Number of workers synced concurrently (default is qual_sync_concurrency or 8)', type=positive_int)
+
+    dispatch_outbox_parser = subparsers.add_parser(
+        'dispatch-outbox',
+        description='Send the approvals and rejections queued by the review UI to MTurk, and push pending qualification scores'
+    )
+    dispatch_outbox_parser.add_argument('--workers', '-w', help='Number of concurrent MTurk calls (default is mturk_outbox_concurrency or 8)', type=positive_int)
+    dispatch_outbox_parser.add_argument('--retry-failed', help='Retry entries which failed before', action='store_true')
+
+    backfill_qual_points_parser = subparsers.add_parser(
+        'backfill-qual-points',
+        description='Recompute the stored qual_points_total of workers where it is missing or differs from their qualification pages and verification points'
+    )
+    backfill_qual_points_parser.add_argument('--verify', help='Only report the workers whose total is missing or wrong', action='store_true')
+
+    recompute_stats_parser = subparsers.add_parser(
+        'recompute-stats',
+        description='Rebuild the page status counts and worker points histogram shown on the dashboard from the pages and workers collections'
+    )
+
+    backfill_worker_env_parser = subparsers.add_parser(
+        'backfill-worker-env',
+        description='Assign the env of the env file to all workers without one, so that queries by env can use an index. '
+            'Run it once with the env file of the environment the existing workers belong to.'
+    )
 
     args = parser.parse_args()
     
@@ -147,10 +231,18 @@ if __name__ == '__main__':
 
 from sci_annot_eval.common.bounding_box import RelativeBoundingBox
 import pandas as pd
+import pyarrow
+import pyarrow.parquet as pq
 from enums.page_status import PageStatus
 from enums.qualification_types import QualificationType
 import repository
 import mturk_client
+import page_images
+import answer_shards
+import mturk_outbox
+import qualification_sync
+import worker_notifications
+from parallel import chunked, process_pool, run_bounded
 from question_form_answers_parser import xml_to_dict, sci_annot_parsers_dict
 from sci_annot_eval import evaluation
 from sci_annot_eval.parsers import sci_annot_parser
@@ -160,13 +252,35 @@ from sci_annot_eval.helpers import helpers
 
 answer_parser = sci_annot_parser.SciAnnotParser()
 
-def ingest(path):
-    data = pd.read_parquet(path)
+def ingest(path, batch_size: int = 10000, upsert: bool = False, restart: bool = False):
+    """Ingests a render summary parquet file into the database.
+
+    Args:
+        path (str): Path to the parquet file.
+        batch_size (int, optional): Number of PDFs read at once. Defaults to 10000.
+        upsert (bool, optional): Skip existing documents and checkpoint after each batch,
+            so that an interrupted ingest can be resumed by running it again. Defaults to False.
+        restart (bool, optional): Ignore an existing checkpoint of the file. Defaults to False.
+    """
+    parquet_file = pq.ParquetFile(path)
     logging.info(f'Ingesting {path} into database...')
 
-    repository.ingest_pdfs(data)
+    checkpoint_id = None
+    if upsert:
+        # The same file read with the same batch size always yields the same batches
+        checkpoint_id = f'{os.path.abspath(path)}:{os.path.getsize(path)}:{batch_size}'
+        if restart:
+            repository.delete_ingest_checkpoint(checkpoint_id)
+
+    report = repository.ingest_pdfs(
+        parquet_file.iter_batches(batch_size=batch_size),
+        upsert=upsert,
+        checkpoint_id=checkpoint_id
+    )
     
-    logging.info(f'Finished ingesting {data.shape[0]} rows')
+    logging.info(f'Finished ingesting {parquet_file.metadata.num_rows} rows')
+    for collection, counts in report.items():
+        logging.info(f'{collection}: {counts["inserted"]} inserted, {counts["existing"]} already existed, {counts["failed"]} failed')
     
 def create_hit_type(active: bool = False):
     params = {
@@ -235,18 +349,31 @@ def publish_random(
     comment: Optional[str] = None,
     minimum_qual_points: int= 0,
     did_qual_tasks_required: bool= False,
-    maximum_qual_points: int= 0
+    maximum_qual_points: int= 0,
+    workers: int = 1
 ):
     unpublished = repository.get_random_pages_by_status([PageStatus.NOT_ANNOTATED], count, True)
     qual_requirements = create_postqual_requirements(minimum_qual_points, did_qual_tasks_required, maximum_qual_points)
-    publish([page['_id'] for page in unpublished], comment, qual_requirements= qual_requirements)
+    publish([page['_id'] for page in unpublished], comment, qual_requirements= qual_requirements, workers= workers)
 
 def publish(
     ids: list[str],
     comment: Optional[str] = None,
     max_assignments: int = int(Config.get('max_assignments')),
-    qual_requirements: list = []
+    qual_requirements: list = [],
+    workers: int = 1,
+    batch_size: int = 50
 ):
+    """Creates one HIT per page and marks the pages as submitted.
+
+    Args:
+        ids (list[str]): Page IDs to publish.
+        comment (Optional[str], optional): Comment passed to the HITs. Defaults to None.
+        max_assignments (int, optional): Max. number of assignments per HIT. Defaults to max_assignments from the .env file.
+        qual_requirements (list, optional): Qualification requirements of the HITs. Defaults to none.
+        workers (int, optional): Number of HITs created concurrently. Defaults to 1.
+        batch_size (int, optional): Number of published pages written to the DB at once. Defaults to 50.
+    """
     active_hit_type = repository.get_active_hit_type_or_by_id()
     
     logging.info(f'Active hit type: {active_hit_type}')
@@ -258,94 +385,183 @@ def publish(
             print('Cancelling action...')
             return
 
-    page_id_HIT_response_map = {}
-    for page in ids:
+    def create_page_hit(page: str) -> dict:
         img_url = Config.get('image_url_base') + page + Config.get('image_extension')
-        try:
-            if len(qual_requirements):
-                response = mturk_client.create_hit(
-                    active_hit_type,
-                    img_url,
-                    comment,
-                    max_assignments,
-                    qual_requirements
-                )
-            else:
-                response = mturk_client.create_hit_with_hit_type(
-                    active_hit_type['_id'],
-                    img_url,
-                    comment,
-                    max_assignments,
-                )
+        if len(qual_requirements):
+            return mturk_client.create_hit(
+                active_hit_type,
+                img_url,
+                comment,
+                max_assignments,
+                qual_requirements
+            )
+        else:
+            return mturk_client.create_hit_with_hit_type(
+                active_hit_type['_id'],
+                img_url,
+                comment,
+                max_assignments,
+            )
+
+    # Successful HITs are written to the DB in batches, so that a crash doesn't leave paid HITs without a record.
+    # After the first failure no new HITs are created, but the ones already in flight are still recorded.
+    page_id_HIT_response_map = {}
+    failed = False
+    nr_published = 0
+    # Create the client before the threads do
+    mturk_client.Client.get()
+    try:
+        for page, future in run_bounded(create_page_hit, ids, workers, lambda: failed):
+            try:
+                response = future.result()
+            except Exception as e:
+                logging.error(f'Could not create HIT. Exception was: "{e}"')
+                failed = True
+                continue
             if(response['ResponseMetadata']['HTTPStatusCode'] == 200):
                 logging.debug(f'Created hit: {response}')
                 page_id_HIT_response_map[page] = response
+                if len(page_id_HIT_response_map) >= batch_size:
+                    repository.update_pages_to_submitted(page_id_HIT_response_map)
+                    nr_published += len(page_id_HIT_response_map)
+                    page_id_HIT_response_map = {}
+                    logging.info(f'Published {nr_published}/{len(ids)} HITs')
             else:
                 logging.error(f'Could not create HIT. Response was: {response}')
-                break
-        except Exception as e:
-            logging.error(f'Could not create HIT. Exception was: "{e}"')
-            break
-    
-    repository.update_pages_to_submitted(page_id_HIT_response_map)
+                failed = True
+    finally:
+        repository.update_pages_to_submitted(page_id_HIT_response_map)
+        nr_published += len(page_id_HIT_response_map)
+        logging.info(f'Published {nr_published}/{len(ids)} HITs')
+
+def fetch_page_result(page: dict, hit: Optional[dict] = None) -> Optional[dict]:
+    """Checks the latest HIT of a submitted page and parses its assignments if it is reviewable.
+
+    Args:
+        page (dict): Page document with a HIT_ids field.
+        hit (Optional[dict], optional): Already known HIT of the page. If None, it is fetched from MTurk.
+
+    Returns:
+        Optional[dict]: Update operation for the page, or None if the HIT is not reviewable yet.
+    """
+    latest_hit_id = page['HIT_ids'][-1]
+    if hit is None:
+        hit = mturk_client.get_HIT_status(latest_hit_id)['HIT']
+    if (hit['HITStatus'] != 'Reviewable'):
+        return None
+
+    nr_assignments_available = hit['NumberOfAssignmentsAvailable']
+    page_status = PageStatus.RETRIEVED.value if nr_assignments_available == 0 else PageStatus.EXPIRED.value
+
+    parsed_assignments = [{
+        'assignment_id': assignment['AssignmentId'],
+        'worker_id': assignment['WorkerId'],
+        'HIT_id': assignment['HITId'],
+        'auto_approval_time': assignment['AutoApprovalTime'],
+        'submit_time': assignment['SubmitTime'],
+        'reviewed': False,
+        'environment': Config.get('env_name'),
+        'answer': xml_to_dict(assignment['Answer'], sci_annot_parsers_dict),
+    } for assignment in mturk_client.iter_HIT_assignments(latest_hit_id)]
 
-def fetch_hit_results():
-    submitted_pages = repository.get_random_pages_by_status([PageStatus.SUBMITTED])
-    nr_found_pages = len(submitted_pages)
-    logging.info(f'Found {nr_found_pages} submitted pages.')
+    operation = {
+        '$set': {
+            'status': page_status
+        }
+    }
+    if parsed_assignments:
+        operation['$push'] = {
+            'assignments': {'$each': parsed_assignments}
+        }
+    return operation
+
+def get_reviewable_page_HITs(active_hit_type_only: bool = False) -> list[tuple[dict, dict]]:
+    """Lists the reviewable HITs on MTurk and joins them to the submitted pages they were published for.
+    HITs which are not the latest HIT of a submitted page are ignored.
+
+    Args:
+        active_hit_type_only (bool, optional): Only list HITs of the active HIT type.
+            HITs published with qualification requirements get their own HIT type, so they are skipped in this case.
+            Defaults to False.
+
+    Returns:
+        list[tuple[dict, dict]]: (page, HIT) pairs.
+    """
+    hit_type_id = repository.get_active_hit_type_or_by_id()['_id'] if active_hit_type_only else None
+    reviewable_hits = {hit['HITId']: hit for hit in mturk_client.list_reviewable_HITs(hit_type_id)}
+    logging.info(f'Found {len(reviewable_hits)} reviewable HITs.')
+
+    page_hit_pairs = []
+    for page in repository.get_submitted_pages_by_HIT_ids(list(reviewable_hits.keys())):
+        latest_hit_id = page['HIT_ids'][-1]
+        if latest_hit_id in reviewable_hits:
+            page_hit_pairs.append((page, reviewable_hits[latest_hit_id]))
+    return page_hit_pairs
+
+def fetch_hit_results(
+    workers: int = 1,
+    batch_size: int = 100,
+    list_reviewable: bool = False,
+    active_hit_type_only: bool = False
+):
+    """Fetches the results of reviewable HITs of submitted pages and saves them.
+
+    By default, the HIT of every submitted page is polled. If list_reviewable is set,
+    the reviewable HITs are listed instead, and only their pages are fetched.
+    HITs are handled concurrently, and the results are written to the DB in batches as they arrive,
+    so an interrupted run keeps the progress made so far.
+
+    Args:
+        workers (int, optional): Number of HITs handled concurrently. Defaults to 1.
+        batch_size (int, optional): Number of page updates written to the DB at once. Defaults to 100.
+        list_reviewable (bool, optional): List reviewable HITs instead of polling every submitted page. Defaults to False.
+        active_hit_type_only (bool, optional): When listing, only consider HITs of the active HIT type. Defaults to False.
+    """
+    if list_reviewable:
+        page_hit_pairs = get_reviewable_page_HITs(active_hit_type_only)
+    else:
+        page_hit_pairs = [(page, None) for page in repository.get_random_pages_by_status([PageStatus.SUBMITTED])]
+    nr_found_pages = len(page_hit_pairs)
+    logging.info(f'Found {nr_found_pages} submitted pages to fetch.')
 
     operation_dict = {}
+    status_counter = Counter()
     nr_feedback_messages = 0
-    for page in submitted_pages:
-        latest_hit_id = page['HIT_ids'][-1]
-        status = mturk_client.get_HIT_status(latest_hit_id)
-        if (status['HIT']['HITStatus'] == 'Reviewable'):
-            nr_assignments_available = status['HIT']['NumberOfAssignmentsAvailable']
-            status = PageStatus.RETRIEVED.value if nr_assignments_available == 0 else PageStatus.EXPIRED.value
-
-            result_response = mturk_client.get_HIT_results(latest_hit_id)
-            nr_results = result_response['NumResults']
-            parsed_assignments = []
-            if (nr_results > 0):
-                for assignment in result_response['Assignments']:
-                    parsed_answer = xml_to_dict(assignment['Answer'], sci_annot_parsers_dict)
-                    if 'feedback' in parsed_answer:
+    nr_polled = 0
+    start = time.time()
+    # Create the client before the threads do
+    mturk_client.Client.get()
+    try:
+        for (page, _), future in run_bounded(lambda pair: fetch_page_result(*pair), page_hit_pairs, workers):
+            operation = future.result()
+            nr_polled += 1
+            if operation is not None:
+                operation_dict[page['_id']] = operation
+                status_counter[operation['$set']['status']] += 1
+                for assignment in operation.get('$push', {}).get('assignments', {}).get('$each', []):
+                    if 'feedback' in assignment['answer']:
                         nr_feedback_messages += 1
-                    parsed_assignments.append({
-                        'assignment_id': assignment['AssignmentId'],
-                        'worker_id': assignment['WorkerId'],
-                        'HIT_id': assignment['HITId'],
-                        'auto_approval_time': assignment['AutoApprovalTime'],
-                        'submit_time': assignment['SubmitTime'],
-                        'reviewed': False,
-                        'environment': Config.get('env_name'),
-                        'answer': parsed_answer,
-                    })
-
-            operation_dict[page['_id']] = {
-                '$set': {
-                    'status': status
-                }
-            }
-            if parsed_assignments:
-                operation_dict[page['_id']]['$push'] = {
-                    'assignments': {'$each': parsed_assignments}
-                }
-
-    status_counter = Counter(op['$set']['status'] for op in operation_dict.values())
-    status_counter[PageStatus.SUBMITTED.value] = nr_found_pages - len(operation_dict)
+                if len(operation_dict) >= batch_size:
+                    repository.update_pages_from_dict(operation_dict)
+                    operation_dict = {}
+            if nr_polled % batch_size == 0:
+                elapsed = time.time() - start
+                logging.info(f'Polled {nr_polled}/{nr_found_pages} pages ({nr_polled/elapsed:.1f} pages/s), {sum(status_counter.values())} finished')
+    finally:
+        repository.update_pages_from_dict(operation_dict)
+
+    elapsed = time.time() - start
+    if not list_reviewable:
+        status_counter[PageStatus.SUBMITTED.value] = nr_polled - sum(status_counter.values())
+    logging.info(f'Polled {nr_polled} pages in {elapsed:.1f}s')
     logging.info(f'Summary of submitted page statuses: {status_counter}')
     if nr_feedback_messages:
         logging.warning(f'{nr_feedback_messages} feedback message(s) received!')
-    repository.update_pages_from_dict(operation_dict)
 
 def crop_compare_answers(answer_1_raw, answer_2_raw, page_id, iou_threshold=0.95):
-    img_bytes = repository.get_image_as_bytes(page_id)
-    answer_1_parsed = answer_parser.parse_dict_absolute(answer_1_raw)
-    # TODO: Clean this up
-    answer_1_parsed = helpers.make_relative(helpers.crop_all_to_content(img_bytes, answer_1_parsed), answer_1_raw['canvasWidth'], answer_1_raw['canvasHeight'])
-    answer_2_parsed = answer_parser.parse_dict_absolute(answer_2_raw)
-    answer_2_parsed = helpers.make_relative(helpers.crop_all_to_content(img_bytes, answer_2_parsed), answer_2_raw['canvasWidth'], answer_2_raw['canvasHeight'])
+    img = page_images.get_page_image(page_id)
+    answer_1_parsed = page_images.crop_answer(img, answer_1_raw)
+    answer_2_parsed = page_images.crop_answer(img, answer_2_raw)
     return evaluation.check_no_disagreements(answer_1_parsed, answer_2_parsed, iou_threshold)
 
 def compare_assignments(page_id, assignment_1_id, assignment_2_id):
@@ -355,56 +571,100 @@ def compare_assignments(page_id, assignment_1_id, assignment_2_id):
 
     print('Assignments match') if result else print('Assignments don\'t match')
 
-def eval_retrieved():
+class PageEvaluation(NamedTuple):
+    page_id: str
+    # One of 'passed', 'deferred' or 'rejected', or None for qualification pages
+    verdict: Optional[str]
+    # (worker ID, whether the answer matched the ground truth) for each unreviewed qualification assignment
+    worker_matches: list[tuple[str, bool]]
+    # Assignments which should be marked as reviewed
+    reviewed_assignment_ids: list[str]
+
+def evaluate_page(page: dict) -> PageEvaluation:
+    """Automatically evaluates the assignments of a retrieved page.
+    This doesn't touch the DB, so it can run in a worker process.
+    """
+    assignments = page['assignments']
+    nr_assignments = len(assignments)
+    worker_matches = []
+    reviewed_assignment_ids = []
+    verdict = None
+    if (nr_assignments == 0):
+        verdict = 'rejected'
+        logging.warning(f'page {page["_id"]} has no assignments!')
+    elif (nr_assignments == 1):
+        verdict = 'deferred'
+    else:
+        if 'qualification_page' in page.keys() and page['qualification_page']:
+            # This is a qualification page
+            # The page is decoded once and the ground truth is cropped once for all assignments
+            img = None
+            ground_truth = None
+            for assignment in page['assignments']:
+                if 'reviewed' not in assignment.keys() or not assignment['reviewed']:
+                    # TODO: Handle ADMIN!
+                    if img is None:
+                        img = page_images.get_page_image(page['_id'])
+                        ground_truth = page_images.get_cropped_ground_truth(page['_id'], page['assignments'][0]['answer'], img)
+                    curr_answer = page_images.crop_answer(img, assignment['answer'])
+                    match = evaluation.check_no_disagreements(ground_truth, curr_answer, 0.95)
+                    worker_matches.append((assignment['worker_id'], match))
+                    reviewed_assignment_ids.append(assignment['assignment_id'])
+        else:
+            # This is a regular page
+            if (len(assignments) > 2):
+                logging.warning(f'page {page["_id"]} has {len(assignments)} assignments! Only the last two will be evaluated')
+            answer_1_raw = page['assignments'][-2]['answer']
+            answer_2_raw = page['assignments'][-1]['answer']
+            match = crop_compare_answers(answer_1_raw, answer_2_raw, page['_id'])
+
+            if match:
+                logging.debug(f'page {page["_id"]} has matching annotations')
+                verdict = 'passed'
+            else:
+                logging.debug(f'page {page["_id"]} doesn\'t have matching annotations')
+                verdict = 'deferred'
+
+    return PageEvaluation(page['_id'], verdict, worker_matches, reviewed_assignment_ids)
+
+def eval_retrieved(workers: int = 1, chunk_size: int = 16):
+    """Evaluates all retrieved pages and updates their status, as well as the workers who did qualification pages.
+
+    Args:
+        workers (int, optional): Number of worker processes used for evaluation. Defaults to 1, which evaluates in this process.
+        chunk_size (int, optional): Number of pages sent to a worker process at once. Defaults to 16.
+    """
     repository.assert_qual_types_exist()
     retrieved = repository.get_random_pages_by_status([PageStatus.RETRIEVED])
-    passed = []
-    deferred = []
-    rejected = []
+    verdict_lists = {'passed': [], 'deferred': [], 'rejected': []}
+    passed = verdict_lists['passed']
+    deferred = verdict_lists['deferred']
+    rejected = verdict_lists['rejected']
     worker_id_action_dict = {}
+    completed_qual_pages = []
     assignment_action_list = []
-    for page in retrieved:
-        assignments = page['assignments']
-        nr_assignments = len(assignments)
-        if (nr_assignments == 0):
-            rejected.append(page['_id'])
-            logging.warning(f'page {page["_id"]} has no assignments!')
-        elif (nr_assignments == 1):
-            deferred.append(page['_id'])
-        else:
-            if 'qualification_page' in page.keys() and page['qualification_page']:
-                # This is a qualification page
-                ground_truth_raw = page['assignments'][0]['answer']
-                for assignment in page['assignments']:
-                    if 'reviewed' not in assignment.keys() or not assignment['reviewed']:
-                        worker_id = assignment['worker_id']
-                        # TODO: Handle ADMIN!
-                        if worker_id not in worker_id_action_dict.keys():
-                            worker_id_action_dict[worker_id] = {'$set': {'did_qualification_tasks': True}}
-                        curr_answer_raw = assignment['answer']
-                        match = crop_compare_answers(ground_truth_raw, curr_answer_raw, page['_id'])
-                        if match:
-                            worker_id_action_dict[worker_id]['$addToSet'] = {
-                                'qual_pages_completed': page['_id']
-                            }
-                        assignment_action_list.append((
-                            {'_id': page['_id'], 'assignments.assignment_id': assignment['assignment_id']},
-                            {'$set': {'assignments.$.reviewed': True}}
-                        ))    
-            else:
-                # This is a regular page
-                if (len(assignments) > 2):
-                    logging.warning(f'page {page["_id"]} has {len(assignments)} assignments! Only the last two will be evaluated')
-                answer_1_raw = page['assignments'][-2]['answer']
-                answer_2_raw = page['assignments'][-1]['answer']
-                match = crop_compare_answers(answer_1_raw, answer_2_raw, page['_id'])
 
+    def reduce_evaluations(evaluations):
+        for page_eval in evaluations:
+            if page_eval.verdict is not None:
+                verdict_lists[page_eval.verdict].append(page_eval.page_id)
+            for worker_id, match in page_eval.worker_matches:
+                if worker_id not in worker_id_action_dict.keys():
+                    worker_id_action_dict[worker_id] = qualification_sync.mark_pending({'$set': {'did_qualification_tasks': True}})
                 if match:
-                    logging.debug(f'page {page["_id"]} has matching annotations')
-                    passed.append(page['_id'])
-                else:
-                    logging.debug(f'page {page["_id"]} doesn\'t have matching annotations')
-                    deferred.append(page['_id'])
+                    completed_qual_pages.append((worker_id, page_eval.page_id))
+            for assignment_id in page_eval.reviewed_assignment_ids:
+                assignment_action_list.append((
+                    {'_id': page_eval.page_id, 'assignments.assignment_id': assignment_id},
+                    {'$set': {'assignments.$.reviewed': True}}
+                ))
+
+    if workers > 1:
+        # Results come back in input order, so the outcome is the same as with serial evaluation
+        with process_pool(workers) as executor:
+            reduce_evaluations(executor.map(evaluate_page, retrieved, chunksize=chunk_size))
+    else:
+        reduce_evaluations(map(evaluate_page, retrieved))
 
     logging.info(f'Validation results: {len(passed)} - good, {len(deferred)} - deferred, {len(rejected)} - rejected.')
 
@@ -415,68 +675,228 @@ def eval_retrieved():
     repository.update_pages_from_tuples(assignment_action_list)
     if worker_id_action_dict:
         repository.update_workers_from_dict(worker_id_action_dict)
-        updated_workers_curr_state = repository.get_workers_in_id_list(list(worker_id_action_dict.keys()))
-        did_qual_tasks_id = repository.get_qual_type_id(QualificationType.DID_QUAL_TASKS)
-        qual_points_id = repository.get_qual_type_id(QualificationType.QUAL_POINTS)
-        # This is just to satisfy the type system.
-        # The assertion that these are not None is done at the beginning of the func.
-        if did_qual_tasks_id is not None and qual_points_id is not None:
-            for worker in updated_workers_curr_state:
-                mturk_client.assign_qualification_to_worker(did_qual_tasks_id, worker['_id'])
-                total_qual_points = len(worker['qual_pages_completed']) + worker['verification_points'] if 'verification_points' in worker.keys() else 0
-                mturk_client.assign_qualification_to_worker(qual_points_id, worker['_id'], total_qual_points)
+        repository.add_completed_qual_pages(completed_qual_pages)
+        qualification_sync.sync_workers(list(worker_id_action_dict.keys()))
 
 def start_server():
     os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'web.settings')
     application = get_wsgi_application()
     management.call_command('runserver')
 
-def export_answers(output_dir: str, crop_whitespace: bool):
-    logging.debug('Cropping whitespace in output...')
-    existing_ids = [file.split('.')[0] for file in os.listdir(output_dir)]
-    accepted_page_assignments = repository.get_accepted_assignments(existing_ids)
-    summary_dict = {}
+EXPORT_SUMMARY_FILE = 'export_summary.parquet'
+# Summary rows of export batches which haven't been compacted into EXPORT_SUMMARY_FILE yet
+EXPORT_SUMMARY_PARTS_DIR = 'export_summary_parts'
+EXPORT_SHARDS_DIR = 'shards'
+# The page ID is the pandas index of the summary
+EXPORT_SUMMARY_SCHEMA = pyarrow.schema([
+    ('__index_level_0__', pyarrow.string()),
+    ('status', pyarrow.string()),
+    ('worker_id', pyarrow.string()),
+    ('shard', pyarrow.string()),
+    ('offset', pyarrow.int64()),
+])
 
-    nr_files = 0
-    for page_assig in accepted_page_assignments:
-        logging.debug(f'Exporting page {page_assig["_id"]}')
-        if crop_whitespace:
-            assignment = page_assig['assignment']
-            orig_answer = assignment['answer']
-            orig_bboxes = answer_parser.parse_dict_absolute(orig_answer)
-            img_bytes = repository.get_image_as_bytes(page_assig['_id'])
-            cropped_bboxes = helpers.crop_all_to_content(img_bytes, orig_bboxes)
-            relative_cropped_bboxes = helpers.make_relative(
-                cropped_bboxes,
-                int(orig_answer['canvasWidth']),
-                int(orig_answer['canvasHeight'])
-            )
-            exported_annots = answer_exporter.export_to_dict(
-                relative_cropped_bboxes,
-                int(orig_answer['canvasWidth']),
-                int(orig_answer['canvasHeight'])
+def write_atomically(path: str, data: str):
+    """Writes data to a temporary file next to path and renames it, so readers never see a half-written file.
+    """
+    tmp_fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or None, suffix='.tmp')
+    try:
+        with os.fdopen(tmp_fd, 'w') as file:
+            file.write(data)
+        os.chmod(tmp_path, repository.NEW_FILE_MODE)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+def crop_exported_answer(page_assig: dict):
+    """Crops the whitespace around the bounding boxes of an accepted assignment's answer in place.
+    """
+    orig_answer = page_assig['assignment']['answer']
+    orig_bboxes = answer_parser.parse_dict_absolute(orig_answer)
+    # Every page is exported once, so caching its image would only evict more useful entries
+    img = page_images.get_page_image(page_assig['_id'], use_cache=False)
+    cropped_bboxes = page_images.crop_all_to_content(img, orig_bboxes)
+    relative_cropped_bboxes = helpers.make_relative(
+        cropped_bboxes,
+        int(orig_answer['canvasWidth']),
+        int(orig_answer['canvasHeight'])
+    )
+    exported_annots = answer_exporter.export_to_dict(
+        relative_cropped_bboxes,
+        int(orig_answer['canvasWidth']),
+        int(orig_answer['canvasHeight'])
+    )
+    orig_answer['annotations'] = exported_annots['annotations']
+
+def export_page(page_assig: dict, output_dir: str, crop_whitespace: bool) -> tuple[str, str, str, None, None]:
+    """Saves the answer of an accepted assignment to its own JSON file.
+    This doesn't touch the DB, so it can run in a worker process.
+
+    Returns:
+        tuple[str, str, str, None, None]: Summary row of page ID, page status and worker ID, and no shard and offset.
+    """
+    if crop_whitespace:
+        crop_exported_answer(page_assig)
+    write_atomically(
+        os.path.join(output_dir, page_assig['_id']+'.json'),
+        json.dumps(page_assig['assignment']['answer'], indent=4)
+    )
+    return page_assig['_id'], page_assig['status'], page_assig['assignment']['worker_id'], None, None
+
+def prepare_answer_record(page_assig: dict, crop_whitespace: bool) -> dict:
+    """Prepares the answer of an accepted assignment for a shard, see answer_shards.make_answer_record.
+    This doesn't touch the DB, so it can run in a worker process.
+    """
+    if crop_whitespace:
+        crop_exported_answer(page_assig)
+    return answer_shards.make_answer_record(
+        page_assig['_id'],
+        page_assig['status'],
+        page_assig['assignment']['worker_id'],
+        page_assig['assignment']['answer']
+    )
+
+def get_summary_part_paths(output_dir: str) -> list[str]:
+    parts_dir = os.path.join(output_dir, EXPORT_SUMMARY_PARTS_DIR)
+    if not os.path.isdir(parts_dir):
+        return []
+    return [os.path.join(parts_dir, file) for file in sorted(os.listdir(parts_dir)) if file.endswith('.parquet')]
+
+def write_summary_part(output_dir: str, rows: list[tuple]):
+    """Saves summary rows of (page ID, status, worker ID, shard, offset) as a new summary part.
+    """
+    summary_df = pd.DataFrame.from_dict(
+        {row[0]: list(row[1:]) for row in rows},
+        orient='index',
+        columns=['status', 'worker_id', 'shard', 'offset']
+    )
+    part_path = os.path.join(output_dir, EXPORT_SUMMARY_PARTS_DIR, f'{time.time_ns()}.parquet')
+    pq.write_table(pyarrow.Table.from_pandas(summary_df, schema=EXPORT_SUMMARY_SCHEMA, preserve_index=True), part_path + '.tmp')
+    os.replace(part_path + '.tmp', part_path)
+
+def mark_summary_exported(output_dir: str, batch_size: int = 1000):
+    """Marks the pages in the export summary of output_dir as exported, unless their status changed since,
+    see repository.mark_pages_exported. Summaries written before the marker existed need this once,
+    otherwise the next export-answers exports all of their pages again.
+    """
+    summary_paths = get_summary_part_paths(output_dir)
+    export_summary_path = os.path.join(output_dir, EXPORT_SUMMARY_FILE)
+    if os.path.isfile(export_summary_path):
+        summary_paths.insert(0, export_summary_path)
+    nr_pages = 0
+    for path in summary_paths:
+        summary_file = pq.ParquetFile(path)
+        id_column = summary_file.schema_arrow.pandas_metadata['index_columns'][0]
+        for batch in summary_file.iter_batches(batch_size, columns=[id_column, 'status']):
+            repository.mark_pages_exported(
+                list(zip(batch.column(id_column).to_pylist(), batch.column('status').to_pylist())),
+                datetime.now()
             )
-            orig_answer['annotations'] = exported_annots['annotations']
-        file_path = os.path.join(output_dir, page_assig['_id']+'.json')
-        summary_dict[page_assig['_id']] = [
-            page_assig['status'],
-            page_assig['assignment']['worker_id']
-        ]
-        with open(file_path, 'w+') as of:
-            json.dump(page_assig['assignment']['answer'], of, indent=4)
-        nr_files+= 1
-        logging.debug(f'{nr_files}/??: page {page_assig["_id"]} saved')
-    logging.info(f'Saved {nr_files} assignments to disk.')
+            nr_pages += batch.num_rows
+    logging.info(f'Marked the {nr_pages} page(s) of the export summary in {output_dir} as exported')
 
-    export_summary_path = os.path.join(output_dir, 'export_summary.parquet')
+def compact_export_summary(output_dir: str):
+    """Merges the summary parts into export_summary.parquet one record batch at a time,
+    where newer rows replace older ones with the same page ID.
+    """
+    part_paths = get_summary_part_paths(output_dir)
+    if not part_paths:
+        return
+    export_summary_path = os.path.join(output_dir, EXPORT_SUMMARY_FILE)
+    source_paths = list(reversed(part_paths))
     if os.path.isfile(export_summary_path):
-        logging.debug('Existing summary found, appending to it...')
-        new_summary_df = pd.DataFrame.from_dict(summary_dict, orient='index', columns=['status', 'worker_id'])
-        summary_df = pd.read_parquet(export_summary_path)
-        summary_df = new_summary_df.combine_first(summary_df)
+        source_paths.append(export_summary_path)
+
+    schema = pq.read_schema(part_paths[0])
+    id_column = schema.pandas_metadata['index_columns'][0]
+    written_ids = set()
+    tmp_path = export_summary_path + '.tmp'
+    with pq.ParquetWriter(tmp_path, schema) as writer:
+        for path in source_paths:
+            for batch in pq.ParquetFile(path).iter_batches():
+                ids = batch.column(id_column).to_pylist()
+                batch = batch.filter(pyarrow.array([id not in written_ids for id in ids]))
+                written_ids.update(ids)
+                table = pyarrow.Table.from_batches([batch])
+                # Summaries of older versions don't have all columns
+                for field in schema:
+                    if field.name not in table.column_names:
+                        table = table.append_column(field.name, pyarrow.nulls(len(table), field.type))
+                writer.write_table(table.select(schema.names).cast(schema))
+    os.replace(tmp_path, export_summary_path)
+    for path in part_paths:
+        os.remove(path)
+    logging.debug(f'Compacted {len(part_paths)} summary part(s) into {export_summary_path}')
+
+def export_answers(
+    output_dir: str,
+    crop_whitespace: bool,
+    workers: int = 1,
+    batch_size: int = 1000,
+    format: str = 'json',
+    shard_max_bytes: int = 256 * 1024**2
+):
+    """Saves the answers of all accepted assignments which haven't been exported to output_dir yet,
+    and adds them to the export summary.
+
+    In the json format, every answer is saved to its own file. In the jsonl and parquet formats, answers are saved
+    into shards of roughly shard_max_bytes in the shards subdirectory, see answer_shards.ShardWriter.
+    The summary has the shard and offset of each of these answers.
+
+    Pages are streamed from the DB in batches. After the answers of a batch are written, its summary rows are saved
+    as a separate part, and the pages are marked as exported in the DB.
+    At the end, all parts are compacted into export_summary.parquet.
+    If output_dir already has a summary, only pages which weren't marked as exported or changed their status since
+    are exported, so an interrupted export can be resumed by running it again.
+    The marker isn't specific to an output directory, so incremental exports should always go to the same one.
+    Summaries saved before pages were marked need mark_summary_exported once.
+
+    Args:
+        output_dir (str): Output directory.
+        crop_whitespace (bool): Crop whitespace around bounding boxes.
+        workers (int, optional): Number of worker processes which crop the pages. Defaults to 1.
+        batch_size (int, optional): Number of pages per batch. Defaults to 1000.
+        format (str, optional): One of json, jsonl or parquet. Defaults to 'json'.
+        shard_max_bytes (int, optional): Size after which a new shard is started. Defaults to 256MiB.
+    """
+    incremental = os.path.isfile(os.path.join(output_dir, EXPORT_SUMMARY_FILE)) or bool(get_summary_part_paths(output_dir))
+    logging.info(f'Exporting {"pages changed since the last export" if incremental else "all accepted pages"}')
+    os.makedirs(os.path.join(output_dir, EXPORT_SUMMARY_PARTS_DIR), exist_ok=True)
+    accepted_page_assignments = repository.get_accepted_assignments(incremental, batch_size)
+
+    shard_writer = None
+    if format == 'json':
+        export = functools.partial(export_page, output_dir=output_dir, crop_whitespace=crop_whitespace)
     else:
-        summary_df = pd.DataFrame.from_dict(summary_dict, orient='index', columns=['status', 'worker_id'])
-    summary_df.to_parquet(export_summary_path)
+        export = functools.partial(prepare_answer_record, crop_whitespace=crop_whitespace)
+        shard_writer = answer_shards.SHARD_WRITERS[format](os.path.join(output_dir, EXPORT_SHARDS_DIR), shard_max_bytes)
+
+    def save_summary_rows(rows: list[tuple]):
+        # Only pages whose answers are completely written are marked
+        write_summary_part(output_dir, rows)
+        repository.mark_pages_exported([(row[0], row[1]) for row in rows], datetime.now())
+
+    nr_files = 0
+    start = time.time()
+    with (process_pool(workers) if workers > 1 else contextlib.nullcontext()) as executor:
+        for batch in chunked(accepted_page_assignments, batch_size):
+            if executor is not None:
+                results = list(executor.map(export, batch, chunksize=max(1, len(batch) // (4 * workers))))
+            else:
+                results = [export(page_assig) for page_assig in batch]
+            rows = results if shard_writer is None else shard_writer.write(results)
+            if rows:
+                save_summary_rows(rows)
+            nr_files += len(results)
+            logging.info(f'Saved {nr_files} assignment(s) ({nr_files / (time.time() - start):.1f} pages/s)')
+        if shard_writer is not None:
+            rows = shard_writer.close()
+            if rows:
+                save_summary_rows(rows)
+    logging.info(f'Saved {nr_files} assignments to disk.')
+
+    compact_export_summary(output_dir)
 
 def create_qual_types():
     created_nr = 0
@@ -508,7 +928,7 @@ def mark_pages_for_qual(ids: list[str]):
             action_dict[page['_id']] = {'$set': {'qualification_page': True}}
     repository.update_pages_from_dict(action_dict)
 
-def pub_qual_pages(max_assignments: int = 10):
+def pub_qual_pages(max_assignments: int = 10, workers: int = 1):
     qual_pages = repository.get_qualification_pages()
     id_list = []
     for page in qual_pages:
@@ -526,8 +946,45 @@ def pub_qual_pages(max_assignments: int = 10):
         'ActionsGuarded': 'DiscoverPreviewAndAccept'
     }]
 
-    publish(id_list, max_assignments= max_assignments, qual_requirements= qual_requirements)
+    publish(id_list, max_assignments= max_assignments, qual_requirements= qual_requirements, workers= workers)
     
+def prefetch_images(ids: Optional[list[str]] = None, statuses: Optional[list[str]] = None, workers: int = 8):
+    """Downloads the images of the given pages, or of all pages in the given statuses, if they are missing locally.
+
+    Args:
+        ids (Optional[list[str]], optional): Page IDs. Defaults to None.
+        statuses (Optional[list[str]], optional): Page status names, used if no IDs are given. Defaults to None.
+        workers (int, optional): Number of concurrent downloads. Defaults to 8.
+    """
+    if ids:
+        page_ids = ids
+    else:
+        page_statuses = [PageStatus[status.upper()] for status in (statuses or [])]
+        page_ids = [page['_id'] for page in repository.get_random_pages_by_status(page_statuses, id_only=True)]
+    missing_ids = [page_id for page_id in page_ids if not os.path.isfile(repository.get_image_path(page_id))]
+    logging.info(f'{len(missing_ids)} out of {len(page_ids)} images are missing locally')
+
+    nr_downloaded = 0
+    nr_failed = 0
+    for page_id, future in run_bounded(repository.download_image, missing_ids, workers):
+        if future.exception() is not None:
+            nr_failed += 1
+            logging.error(f'Could not download image of page {page_id}: "{future.exception()}"')
+        else:
+            nr_downloaded += 1
+        if (nr_downloaded + nr_failed) % 100 == 0:
+            logging.info(f'Downloaded {nr_downloaded}/{len(missing_ids)} images')
+    logging.info(f'Downloaded {nr_downloaded} image(s), {nr_failed} failed')
+
+def ensure_indexes():
+    repository.ensure_indexes()
+    logging.info('All indexes exist')
+    scanning_queries = repository.get_collection_scan_queries()
+    if scanning_queries:
+        logging.warning(f'These queries still scan a whole collection: {scanning_queries}')
+    else:
+        logging.info('No query scans a whole collection')
+
 def notify_workers_in_range(subject: str, message_text: str, **kwargs):
     """_summary_
 
@@ -536,27 +993,30 @@ def notify_workers_in_range(subject: str, message_text: str, **kwargs):
         text (str): _description_
         minimum_qual_points (int): Minimum qualification points of workers to notify
         maximum_qual_points (int): Maximum qualification points of workers to notify
+        campaign_id (str): Workers already notified in this campaign are skipped
     """
 
-    workers_in_range = repository.get_workers_in_verification_point_range(
-        kwargs.get('minimum_qual_points', None),
-        kwargs.get('maximum_qual_points', None)
-    )
-    
-    if len(workers_in_range) > 100:
-        # API limit
-        logging.error(f'Found {len(workers_in_range)} workers to notify, but the MTurk api only supports up to 100')
-        return
+    min_points = kwargs.get('minimum_qual_points', None)
+    max_points = kwargs.get('maximum_qual_points', None)
+    logging.info(f'Found {repository.count_workers_in_point_range(min_points, max_points)} worker(s) to notify')
 
-    worker_ids = [worker['_id'] for worker in workers_in_range]
-    mturk_client.notify_workers(subject, message_text, worker_ids)
+    worker_ids = (worker['_id'] for worker in repository.find_workers_in_point_range(min_points, max_points))
+    worker_notifications.notify_workers(subject, message_text, worker_ids, kwargs.get('campaign_id', None))
 
 if __name__ == '__main__':
+    if args.command != 'ensure-indexes':
+        missing_indexes = repository.get_missing_indexes()
+        if missing_indexes:
+            logging.warning(f'Missing DB indexes: {missing_indexes}. Run the ensure-indexes command to create them.')
+    if args.command != 'backfill-worker-env' and repository.has_workers_without_env():
+        logging.warning('Some workers have no env, so they are not counted or notified per env. '
+            'Run the backfill-worker-env command with the env file of the environment they belong to.')
+
     # Handle arguments            
     if args.command == 'mark-pages-for-qualification':
         mark_pages_for_qual(args.ids)
     elif args.command == 'publish-qualification-pages':
-        pub_qual_pages(args.max_assignments)
+        pub_qual_pages(args.max_assignments, args.workers)
     elif args.command == 'publish-random':
         print(f'Args: {args}')
         comment = None
@@ -567,7 +1027,8 @@ if __name__ == '__main__':
             comment,
             args.minimum_qual_points,
             bool(args.require_qualification_done),
-            args.maximum_qual_points
+            args.maximum_qual_points,
+            args.workers
         )
     elif args.command == 'publish-specific':
         comment = None
@@ -578,25 +1039,52 @@ if __name__ == '__main__':
             args.require_qualification_done,
             args.maximum_qual_points
         )
-        publish(args.publish_specific, comment, qual_requirements=qual_reqs)
+        publish(args.ids, comment, qual_requirements=qual_reqs, workers=args.workers)
     elif args.command == 'create-qual-types':
         create_qual_types()
     elif args.command == 'start-server':
         start_server()
     elif args.command == 'fetch-results':
-        fetch_hit_results()
+        fetch_hit_results(args.workers, args.batch_size, args.list_reviewable, args.active_hit_type_only)
     elif args.command == 'eval-retrieved':
-        eval_retrieved()
+        eval_retrieved(args.workers, args.chunk_size)
     elif args.command == 'ingest':
-        ingest(args.parquet_file)
+        ingest(args.parquet_file, args.batch_size, args.upsert, args.restart)
     elif args.command == 'create-hit-type':
         create_hit_type(args.active)
     elif args.command == 'export-answers':
-        export_answers(args.output_dir, args.crop_whitespace)
+        export_answers(args.output_dir, args.crop_whitespace, args.workers, args.batch_size, args.format, args.shard_max_bytes)
+    elif args.command == 'mark-exported':
+        mark_summary_exported(args.output_dir)
     elif args.command == 'compare-assignments':
         compare_assignments(args.page_id, args.assignment_1_id, args.assignment_2_id)
+    elif args.command == 'prefetch-images':
+        prefetch_images(args.ids if 'ids' in args else None, args.statuses if 'statuses' in args else None, args.workers)
+    elif args.command == 'ensure-indexes':
+        ensure_indexes()
+    elif args.command == 'sync-quals':
+        qualification_sync.sync_workers(all_workers=args.all, concurrency=args.workers)
+    elif args.command == 'dispatch-outbox':
+        if args.retry_failed:
+            logging.info(f'Retrying {repository.reset_failed_outbox_entries()} failed outbox entries')
+        mturk_outbox.dispatch(concurrency=args.workers)
+    elif args.command == 'backfill-qual-points':
+        if args.verify:
+            wrong_worker_ids = repository.get_workers_with_wrong_qual_points_total()
+            if wrong_worker_ids:
+                logging.warning(f'{len(wrong_worker_ids)} worker(s) have a missing or wrong qual_points_total, e.g. {wrong_worker_ids[:10]}')
+            else:
+                logging.info('The qual_points_total of all workers is correct')
+        else:
+            logging.info(f'Backfilled the qual_points_total of {repository.backfill_qual_points_total()} worker(s)')
+    elif args.command == 'recompute-stats':
+        repository.recompute_stats()
+    elif args.command == 'backfill-worker-env':
+        logging.info(f'Assigned the env {Config.get("env_name")} to {repository.backfill_worker_env()} worker(s)')
+        # The worker points histogram is counted per env
+        repository.recompute_stats()
     elif args.command == 'notify-specific-workers':
-        mturk_client.notify_workers(args.subject, args.message_text, args.worker_ids)
+        worker_notifications.notify_workers(args.subject, args.message_text, args.worker_ids, args.__dict__.get('campaign_id', None))
     elif args.command == 'notify-workers-in-range':
         print(args)
         range_args = {}
@@ -604,4 +1092,6 @@ if __name__ == '__main__':
             range_args['minimum_qual_points'] = args.minimum_qual_points
         if 'maximum_qual_points' in args.__dict__.keys():
             range_args['maximum_qual_points'] = args.maximum_qual_points
+        if 'campaign_id' in args.__dict__.keys():
+            range_args['campaign_id'] = args.campaign_id
         notify_workers_in_range(args.subject, args.message_text, **range_args)
\ No newline at end of file
@@ -4,20 +4,28 @@ import logging
 import json
 from urllib import parse
 from botocore.config import Config as BotoConfig
+from botocore.exceptions import BotoCoreError, ClientError
+import threading
 from typing import Optional
 
 from enums.qualification_types import QualificationType
 
+# MTurk error codes worth retrying, everything else is a problem with the request itself
+TRANSIENT_ERROR_CODES = {'ServiceFault', 'Throttling', 'ThrottlingException'}
+
 class Client:
     __instance = None
+    # Threads which call get at the same time must not create a client each
+    __lock = threading.Lock()
 
     @staticmethod
     def get():
-        logging.debug(f'Creating a new BOTO3 MTurk client')
-
         if Client.__instance != None:
             return Client.__instance
-        else:
+        with Client.__lock:
+            if Client.__instance != None:
+                return Client.__instance
+            logging.debug(f'Creating a new BOTO3 MTurk client')
             Client.__instance = boto3.client(
                 'mturk',
                 endpoint_url=Config.get('endpoint_url'),
@@ -33,6 +41,14 @@ class Client:
             )
             return Client.__instance
 
+def is_transient_error(e: Exception) -> bool:
+    """Returns whether a failed call is worth retrying, i.e. it failed because of MTurk or the connection.
+    Throttled calls are already retried by the client itself.
+    """
+    if isinstance(e, BotoCoreError):
+        return True
+    return isinstance(e, ClientError) and e.response.get('Error', {}).get('Code') in TRANSIENT_ERROR_CODES
+
 def create_hit_type (
     title: str,
     keywords: str,
@@ -134,9 +150,50 @@ def get_HIT_status(id: str):
     logging.debug(f'HIT status: {response}')
     return response
 
+def iter_HIT_assignments(hit_id: str):
+    """Yields all assignments of a HIT, following NextToken with the largest page size MTurk allows.
+
+    Args:
+        hit_id (str): ID of the HIT.
+    """
+    args = {
+        'HITId': hit_id,
+        'MaxResults': 100
+    }
+    while True:
+        response = Client.get().list_assignments_for_hit(**args)
+        yield from response['Assignments']
+        if not response['Assignments'] or 'NextToken' not in response:
+            break
+        args['NextToken'] = response['NextToken']
+
 def get_HIT_results(hit_id: str)-> dict:
-    response = Client.get().list_assignments_for_hit(HITId=hit_id)
-    return response
+    assignments = list(iter_HIT_assignments(hit_id))
+    return {
+        'NumResults': len(assignments),
+        'Assignments': assignments
+    }
+
+def list_reviewable_HITs(hit_type_id: Optional[str] = None):
+    """Yields every reviewable HIT of the requester, following NextToken until all pages are listed.
+
+    Args:
+        hit_type_id (Optional[str], optional): Only list HITs of this HIT type. Defaults to all HIT types.
+    """
+    args = {
+        'Status': 'Reviewable',
+        'MaxResults': 100
+    }
+    if hit_type_id is not None:
+        args['HITTypeId'] = hit_type_id
+
+    while True:
+        response = Client.get().list_reviewable_hits(**args)
+        logging.debug(f'list_reviewable_hits returned {response["NumResults"]} HIT(s)')
+        yield from response['HITs']
+        if not response['HITs'] or 'NextToken' not in response:
+            break
+        args['NextToken'] = response['NextToken']
 
 def list_hits():
     response = Client.get().list_hits()
@@ -171,6 +228,11 @@ def assign_qualification_to_worker(
     response = Client.get().associate_qualification_with_worker(**args)
     return response
 
+def get_assignment_status(assignment_id: str) -> str:
+    """Returns the status of an assignment on MTurk: Submitted, Approved or Rejected.
+    """
+    return Client.get().get_assignment(AssignmentId=assignment_id)['Assignment']['AssignmentStatus']
+
 def approve_assignment(
     assignment_id: str,
     requester_feedback: str= Config.get('approve_assignment_feedback'),
@@ -192,16 +254,26 @@ def reject_assignment(
         RequesterFeedback=requester_feedback
     )
 
+# Max. number of workers MTurk notifies with one call
+NOTIFY_WORKERS_MAX_RECIPIENTS = 100
+
 def notify_workers(
     subject: str,
     message_text: str,
     worker_ids: list[str]
-):
+) -> list[dict]:
+    """Sends an email to up to NOTIFY_WORKERS_MAX_RECIPIENTS workers.
+
+    Returns:
+        list[dict]: The NotifyWorkersFailureStatuses of the workers who couldn't be notified.
+    """
     if(len(worker_ids)) and subject and message_text:
-        logging.info(f'Notifying {len(worker_ids)} worker(s) with subject "{subject}"')
+        logging.debug(f'Notifying {len(worker_ids)} worker(s) with subject "{subject}"')
         response = Client.get().notify_workers(
             Subject=subject,
             MessageText=message_text,
             WorkerIds=worker_ids
         )
-        logging.debug(f'notify_workers response: {response}')
\ No newline at end of file
+        logging.debug(f'notify_workers response: {response}')
+        return response.get('NotifyWorkersFailureStatuses', [])
+    return []
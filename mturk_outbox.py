@@ -0,0 +1,123 @@
+from datetime import datetime, timedelta
+import logging
+from typing import Callable, NamedTuple, Optional
+from config import Config
+import mturk_client
+from parallel import run_bounded
+import qualification_sync
+import repository
+
+# Outbox action -> MTurk call, which gets the args of the entry as keyword arguments
+OUTBOX_ACTIONS: dict[str, Callable] = {
+    'approve_assignment': mturk_client.approve_assignment,
+    'reject_assignment': mturk_client.reject_assignment,
+}
+
+# Outbox action -> status of the assignment on MTurk once the action took effect
+OUTBOX_DONE_STATUSES: dict[str, str] = {
+    'approve_assignment': 'Approved',
+    'reject_assignment': 'Rejected',
+}
+
+class DispatchResult(NamedTuple):
+    nr_done: int
+    # Entries which failed transiently and will be retried
+    nr_retried: int
+    nr_failed: int
+
+def enqueue_approval(assignment_id: str):
+    """Queues the approval of an assignment. An assignment is approved at most once.
+    Like all writes in repository, this joins the transaction of repository.run_in_transaction.
+    """
+    repository.enqueue_outbox_entries([{
+        '_id': f'approve_assignment:{assignment_id}',
+        'action': 'approve_assignment',
+        'args': {'assignment_id': assignment_id}
+    }])
+
+def enqueue_rejections(assignment_ids: list[str]):
+    """Queues the rejection of assignments. An assignment is rejected at most once.
+    """
+    repository.enqueue_outbox_entries([{
+        '_id': f'reject_assignment:{assignment_id}',
+        'action': 'reject_assignment',
+        'args': {'assignment_id': assignment_id}
+    } for assignment_id in assignment_ids])
+
+def send(entry: dict):
+    """Calls MTurk for an entry. If MTurk refuses the call, but the assignment already has the status the action leads to,
+    the entry counts as done: the action was sent before, but the process stopped before the entry was updated.
+    """
+    try:
+        OUTBOX_ACTIONS[entry['action']](**entry['args'])
+    except Exception as e:
+        if mturk_client.is_transient_error(e) or not is_already_done(entry):
+            raise
+        logging.info(f'Outbox entry {entry["_id"]} was already done on MTurk')
+
+def is_already_done(entry: dict) -> bool:
+    try:
+        return mturk_client.get_assignment_status(entry['args']['assignment_id']) == OUTBOX_DONE_STATUSES[entry['action']]
+    except Exception as e:
+        logging.debug(f'Could not check whether outbox entry {entry["_id"]} was already done: "{e}"')
+        return False
+
+def dispatch(
+    batch_size: int = 100,
+    concurrency: Optional[int] = None,
+    max_attempts: int = 5,
+    backoff_sec: float = 10,
+    lease_sec: float = 300
+) -> DispatchResult:
+    """Sends all due entries of the MTurk outbox, and then pushes the qualification scores of pending workers,
+    see qualification_sync.sync_workers.
+
+    Entries are claimed in batches, so that several dispatchers can run at once. Entries which fail because of MTurk
+    or the connection are retried after an exponentially growing pause, and marked as failed after max_attempts.
+    Entries which MTurk rejects are marked as failed right away, unless the action already took effect, see send.
+
+    Args:
+        batch_size (int, optional): Number of entries claimed at once. Defaults to 100.
+        concurrency (Optional[int], optional): Number of entries sent at once. Defaults to mturk_outbox_concurrency or 8.
+        max_attempts (int, optional): Number of attempts after which an entry fails. Defaults to 5.
+        backoff_sec (float, optional): Pause before the first retry. Defaults to 10.
+        lease_sec (float, optional): How long a batch is reserved for this dispatcher. Defaults to 300.
+
+    Returns:
+        DispatchResult
+    """
+    if concurrency is None:
+        concurrency = int(Config.get_or_default('mturk_outbox_concurrency', 8))
+    nr_done = nr_retried = nr_failed = 0
+    # Create the client before the threads do
+    mturk_client.Client.get()
+    while True:
+        entries = repository.claim_outbox_entries(batch_size, lease_sec)
+        if not entries:
+            break
+        entry_updates = {}
+        for entry, future in run_bounded(send, entries, concurrency):
+            error = future.exception()
+            update: dict = {'$unset': {'claim': '', 'locked_until': ''}}
+            if error is None:
+                nr_done += 1
+                update['$set'] = {'status': 'done', 'done_at': datetime.now()}
+            elif mturk_client.is_transient_error(error) and entry['attempts'] + 1 < max_attempts:
+                nr_retried += 1
+                update['$set'] = {
+                    'attempts': entry['attempts'] + 1,
+                    'next_attempt_at': datetime.now() + timedelta(seconds=backoff_sec * 2**entry['attempts']),
+                    'last_error': str(error)
+                }
+                logging.warning(f'Outbox entry {entry["_id"]} failed, retrying later: "{error}"')
+            else:
+                nr_failed += 1
+                update['$set'] = {'status': 'failed', 'attempts': entry['attempts'] + 1, 'last_error': str(error)}
+                logging.error(f'Outbox entry {entry["_id"]} failed: "{error}"')
+            entry_updates[entry['_id']] = update
+        repository.update_outbox_entries(entry_updates)
+
+    if nr_done or nr_retried or nr_failed:
+        logging.info(f'Dispatched the MTurk outbox: {nr_done} done, {nr_retried} to be retried, {nr_failed} failed')
+    qualification_sync.sync_workers(concurrency=concurrency)
+    return DispatchResult(nr_done, nr_retried, nr_failed)
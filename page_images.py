@@ -0,0 +1,98 @@
+import cv2 as cv
+import numpy as np
+from sci_annot_eval.common.bounding_box import AbsoluteBoundingBox, RelativeBoundingBox
+from sci_annot_eval.helpers import helpers
+from sci_annot_eval.parsers import sci_annot_parser
+from byte_lru_cache import ByteLRUCache
+from config import Config
+import repository
+
+answer_parser = sci_annot_parser.SciAnnotParser()
+
+# Decoded page rasters, keyed by page ID
+DECODED_IMAGE_CACHE = ByteLRUCache(
+    'Decoded image',
+    int(Config.get_or_default('decoded_image_cache_max_bytes', 512 * 1024**2)),
+    lambda img: img.nbytes
+)
+
+# Cropped ground truth bounding boxes of qualification pages, keyed by page ID.
+# Every entry counts as one "byte", so the cache is bounded by its number of pages.
+GROUND_TRUTH_CACHE = ByteLRUCache(
+    'Ground truth',
+    int(Config.get_or_default('ground_truth_cache_max_pages', 1000)),
+    lambda boxes: 1
+)
+
+def decode_grayscale(img_bytes: bytes) -> np.ndarray:
+    """Decodes an encoded image into a grayscale array.
+    The conversion is the same one helpers.crop_to_content does on every crop, so the crops stay identical.
+    """
+    img = cv.imdecode(np.frombuffer(img_bytes, dtype=np.uint8), cv.IMREAD_COLOR)
+    return cv.cvtColor(img, cv.COLOR_BGR2GRAY)
+
+def get_page_image(page_id: str, use_cache: bool = True) -> np.ndarray:
+    """Returns the rasterized page as a decoded grayscale array.
+    Recently used pages are kept in DECODED_IMAGE_CACHE, so the returned array is read-only.
+    Pages which are only read once, e.g. during an export, can bypass the caches with use_cache=False.
+    """
+    def load():
+        img = decode_grayscale(repository.get_image_as_bytes(page_id, use_cache))
+        img.flags.writeable = False
+        return img
+
+    if not use_cache:
+        img = DECODED_IMAGE_CACHE.get(page_id)
+        return img if img is not None else load()
+    return DECODED_IMAGE_CACHE.get_or_load(page_id, load)
+
+def crop_all_to_content(
+    img: np.ndarray,
+    orig_annots: list[AbsoluteBoundingBox],
+    threshold: int= 248
+) -> list[AbsoluteBoundingBox]:
+    """Same as helpers.crop_all_to_content, but works on an already decoded image,
+    so that one page can be decoded once and cropped many times.
+
+    Args:
+        img (np.ndarray): Decoded page, see get_page_image.
+        orig_annots (list[AbsoluteBoundingBox]): Bounding boxes to crop.
+        threshold (int, optional): Pixels darker than this count as content. Defaults to 248.
+
+    Returns:
+        list[AbsoluteBoundingBox]: Cropped bounding boxes.
+    """
+    result_dict = {}
+    for annot in orig_annots:
+        x, y, w, h = helpers.crop_to_content(img, annot, threshold)
+        result_dict[annot] = AbsoluteBoundingBox(
+            annot.type,
+            x,
+            y,
+            h,
+            w,
+            annot.parent
+        )
+
+    # Replace old parent references with new ones
+    for annotation in result_dict.values():
+        if annotation.parent:
+            annotation.parent = result_dict[annotation.parent]
+
+    return list(result_dict.values())
+
+def crop_answer(img: np.ndarray, answer_raw: dict) -> list[RelativeBoundingBox]:
+    """Parses a raw answer, crops its bounding boxes to the content of the page and makes them relative.
+    """
+    answer_parsed = answer_parser.parse_dict_absolute(answer_raw)
+    return helpers.make_relative(
+        crop_all_to_content(img, answer_parsed),
+        answer_raw['canvasWidth'],
+        answer_raw['canvasHeight']
+    )
+
+def get_cropped_ground_truth(page_id: str, answer_raw: dict, img: np.ndarray) -> list[RelativeBoundingBox]:
+    """Returns the cropped ground truth of a qualification page.
+    It is computed from answer_raw and img on the first call, and cached by page ID in GROUND_TRUTH_CACHE after that.
+    """
+    return GROUND_TRUTH_CACHE.get_or_load(page_id, lambda: crop_answer(img, answer_raw))
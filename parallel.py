@@ -0,0 +1,92 @@
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
+import itertools
+import multiprocessing
+import threading
+import time
+from typing import Any, Callable, Iterable, Iterator
+
+def run_bounded(
+    func: Callable[[Any], Any],
+    items: Iterable[Any],
+    max_workers: int,
+    should_stop: Callable[[], bool] = lambda: False
+) -> Iterator[tuple[Any, Future]]:
+    """Runs func over items on a thread pool and yields (item, future) pairs as they complete.
+
+    At most max_workers calls are in flight at any time, so items are consumed lazily.
+    should_stop is checked before every submission, and once it returns True no new items are submitted.
+    Calls that are already running are still awaited and yielded.
+
+    Args:
+        func (Callable[[Any], Any]): Function called with a single item.
+        items (Iterable[Any]): Items to process.
+        max_workers (int): Size of the thread pool.
+        should_stop (Callable[[], bool], optional): Stop condition. Defaults to never stopping.
+
+    Yields:
+        tuple[Any, Future]: The item and its finished future. Exceptions are not raised, but stored in the future.
+
+    Raises:
+        ValueError: If max_workers is less than 1.
+    """
+    if max_workers < 1:
+        raise ValueError(f'max_workers must be at least 1, got {max_workers}')
+    item_iter = iter(items)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        in_flight: dict[Future, Any] = {}
+
+        def fill():
+            while len(in_flight) < max_workers and not should_stop():
+                try:
+                    item = next(item_iter)
+                except StopIteration:
+                    return
+                in_flight[executor.submit(func, item)] = item
+
+        fill()
+        while in_flight:
+            done, _ = wait(in_flight.keys(), return_when=FIRST_COMPLETED)
+            for future in done:
+                yield in_flight.pop(future), future
+            fill()
+
+def process_pool(max_workers: int) -> ProcessPoolExecutor:
+    """Creates a process pool for CPU-bound work.
+
+    Worker processes are forked where possible, so that they inherit the already parsed Config
+    instead of re-importing modules which read it at import time.
+
+    Args:
+        max_workers (int): Number of worker processes.
+    """
+    if 'fork' in multiprocessing.get_all_start_methods():
+        return ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context('fork'))
+    return ProcessPoolExecutor(max_workers=max_workers)
+
+def chunked(items: Iterable[Any], size: int) -> Iterator[list[Any]]:
+    """Yields lists of up to size consecutive items, consuming items lazily.
+    """
+    item_iter = iter(items)
+    while True:
+        chunk = list(itertools.islice(item_iter, size))
+        if not chunk:
+            return
+        yield chunk
+
+class RateLimiter:
+    """Spaces out calls made from any number of threads to at most calls_per_sec per second.
+    """
+
+    def __init__(self, calls_per_sec: float):
+        self.interval = 1 / calls_per_sec
+        self.__next_call = time.monotonic()
+        self.__lock = threading.Lock()
+
+    def wait(self):
+        """Blocks until the next call is allowed.
+        """
+        with self.__lock:
+            now = time.monotonic()
+            call_at = max(now, self.__next_call)
+            self.__next_call = call_at + self.interval
+        time.sleep(call_at - now)
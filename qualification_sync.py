@@ -0,0 +1,153 @@
+from datetime import datetime
+import logging
+import time
+from typing import Callable, Iterable, NamedTuple, Optional
+from config import Config
+from enums.qualification_types import QualificationType
+import mturk_client
+from parallel import run_bounded
+import repository
+
+class SyncResult(NamedTuple):
+    nr_workers: int
+    # Number of qualification scores pushed to MTurk
+    nr_pushed: int
+    # Number of workers whose scores were already up to date
+    nr_unchanged: int
+    nr_failed: int
+
+def get_qual_points(worker: dict) -> int:
+    """Returns the total qualification points of a worker:
+    the number of correctly completed qualification pages plus the verification points, see repository.QUAL_POINTS_TOTAL_EXPRESSION.
+    """
+    return worker.get('qual_points_total', 0)
+
+def get_target_scores(worker: dict) -> dict[QualificationType, Optional[int]]:
+    """Returns the qualification scores a worker should have on MTurk.
+    A score of None assigns the qualification without a value.
+    """
+    targets: dict[QualificationType, Optional[int]] = {QualificationType.QUAL_POINTS: get_qual_points(worker)}
+    if worker.get('did_qualification_tasks'):
+        targets[QualificationType.DID_QUAL_TASKS] = None
+    return targets
+
+def get_score_changes(worker: dict, qual_type_ids: dict[QualificationType, str]) -> dict[str, Optional[int]]:
+    """Diffs the target scores of a worker against the ones last pushed to MTurk, which are kept in its synced_quals field.
+
+    Returns:
+        dict[str, Optional[int]]: Qualification type ID -> score to push.
+    """
+    synced = worker.get('synced_quals', {})
+    changes = {}
+    for qual_type, score in get_target_scores(worker).items():
+        qual_id = qual_type_ids[qual_type]
+        # None can't be told apart from a missing entry, so qualifications without a value are stored as True
+        if synced.get(qual_id) != (True if score is None else score):
+            changes[qual_id] = score
+    return changes
+
+def call_with_retries(func: Callable[[], None], attempts: int = 3, backoff_sec: float = 1.0):
+    """Calls func, and calls it again after an exponentially growing pause if MTurk fails in a way that is worth retrying.
+    The MTurk client already retries throttled calls, this covers service faults and connection errors on top of that.
+    """
+    for attempt in range(1, attempts + 1):
+        try:
+            return func()
+        except Exception as e:
+            if not mturk_client.is_transient_error(e) or attempt == attempts:
+                raise
+            logging.debug(f'Attempt {attempt} failed with "{e}", retrying')
+            time.sleep(backoff_sec * 2**(attempt - 1))
+
+def push_scores(worker_id: str, changes: dict[str, Optional[int]]) -> tuple[dict[str, Optional[int]], Optional[Exception]]:
+    """Pushes the changed scores of one worker, and stops at the first qualification that can't be pushed.
+
+    Returns:
+        tuple[dict[str, Optional[int]], Optional[Exception]]: The scores which were pushed, and the error if there was one.
+    """
+    pushed = {}
+    for qual_id, score in changes.items():
+        try:
+            call_with_retries(lambda: mturk_client.assign_qualification_to_worker(qual_id, worker_id, score))
+        except Exception as e:
+            return pushed, e
+        pushed[qual_id] = score
+    return pushed, None
+
+def sync_workers(worker_ids: Optional[list[str]] = None, all_workers: bool = False, concurrency: Optional[int] = None) -> SyncResult:
+    """Pushes the qualification scores of workers to MTurk, but only those which changed since the last push.
+
+    Writes that change the score of a worker set its qual_sync_pending field, see mark_pending.
+    After the scores of a worker are pushed, they are stored in its synced_quals field and qual_sync_pending is removed,
+    unless the worker changed again in the meantime. If a push fails, the error is stored in qual_sync_error and the worker
+    stays pending, so that a later call without arguments (the sync-quals command) resumes where this one stopped.
+
+    Args:
+        worker_ids (Optional[list[str]], optional): Workers to sync. Defaults to all pending workers.
+        all_workers (bool, optional): Diff every worker instead of only pending ones. Defaults to False.
+        concurrency (Optional[int], optional): Number of workers synced at once. Defaults to qual_sync_concurrency or 8.
+
+    Returns:
+        SyncResult
+    """
+    if worker_ids is not None and not worker_ids:
+        return SyncResult(0, 0, 0, 0)
+    repository.assert_qual_types_exist()
+    qual_type_ids = {qual_type: repository.get_qual_type_id(qual_type) for qual_type in QualificationType}
+    if concurrency is None:
+        concurrency = int(Config.get_or_default('qual_sync_concurrency', 8))
+    workers = repository.get_workers_for_qual_sync(worker_ids, only_pending=worker_ids is None and not all_workers)
+
+    def worker_changes() -> Iterable[tuple[dict, dict[str, Optional[int]]]]:
+        for worker in workers:
+            yield worker, get_score_changes(worker, qual_type_ids)
+
+    # Create the client before the threads do
+    mturk_client.Client.get()
+    nr_workers = nr_pushed = nr_unchanged = nr_failed = 0
+    state_updates = []
+    for (worker, changes), future in run_bounded(lambda item: push_scores(item[0]['_id'], item[1]), worker_changes(), concurrency):
+        nr_workers += 1
+        pushed, error = future.result()
+        nr_pushed += len(pushed)
+        if not changes:
+            nr_unchanged += 1
+        state_updates.extend(get_state_updates(worker, pushed, error))
+        if error is not None:
+            nr_failed += 1
+            logging.error(f'Could not sync the qualifications of worker {worker["_id"]}: "{error}"')
+        if len(state_updates) >= 100:
+            repository.update_workers_from_tuples(state_updates)
+            state_updates = []
+    repository.update_workers_from_tuples(state_updates)
+
+    result = SyncResult(nr_workers, nr_pushed, nr_unchanged, nr_failed)
+    logging.info(f'Synced the qualifications of {nr_workers} worker(s): {nr_pushed} score(s) pushed, '
+        f'{nr_unchanged} worker(s) already up to date, {nr_failed} failed')
+    return result
+
+def get_state_updates(worker: dict, pushed: dict[str, Optional[int]], error: Optional[Exception]) -> list[tuple[dict, dict]]:
+    """Returns the (filter, update) pairs which record the outcome of a sync on the worker document.
+    """
+    update: dict = {'$set': {'qual_sync_time': datetime.now()}}
+    for qual_id, score in pushed.items():
+        update['$set'][f'synced_quals.{qual_id}'] = True if score is None else score
+    if error is not None:
+        update['$set']['qual_sync_error'] = str(error)
+        return [({'_id': worker['_id']}, update)]
+    update['$unset'] = {'qual_sync_error': ''}
+    updates = [({'_id': worker['_id']}, update)]
+    # Only leave the pending state if the worker wasn't changed again since it was read
+    if 'qual_sync_pending' in worker:
+        updates.append((
+            {'_id': worker['_id'], 'qual_sync_pending': worker['qual_sync_pending']},
+            {'$unset': {'qual_sync_pending': ''}}
+        ))
+    return updates
+
+def mark_pending(worker_update: dict) -> dict:
+    """Adds the qual_sync_pending marker to a worker update, so that the write which changes a score also records
+    that it has to be pushed. Returns the same update.
+    """
+    worker_update.setdefault('$set', {})['qual_sync_pending'] = datetime.now()
+    return worker_update
@@ -1,38 +1,434 @@
-import sys
+import argparse
+import itertools
+import logging
 import os
+import shutil
+import subprocess
+import sys
+import tempfile
 import time
-from pdf2image import convert_from_path
+from typing import NamedTuple, Optional
+from pdf2image import pdfinfo_from_path
+from PIL import Image
+from sci_annot_eval.common.bounding_box import AbsoluteBoundingBox, TargetType
+from sci_annot_eval.helpers import helpers
+import pyarrow
+import pyarrow.parquet as pq
+from parallel import process_pool
 
-def dummygenerator(name: str):
-    yield name
+# Format -> extension of the page images
+FORMAT_EXTENSIONS = {
+    'png': 'png',
+    'jpeg': 'jpg',
+    'tiff': 'tif',
+    # pdftoppm can't write WebP, so these pages are rendered as png and converted with Pillow
+    'webp': 'webp',
+}
 
-if __name__ == '__main__':
-    input_dir = sys.argv[1]
-    output_folder = sys.argv[2]
+# Schema of the render summary consumed by the ingest command of manage_HITs.py
+RENDER_SUMMARY_SCHEMA = pyarrow.schema([
+    ('id', pyarrow.string()),
+    ('file', pyarrow.string()),
+    ('page_count', pyarrow.int64()),
+    ('width', pyarrow.int64()),
+    ('height', pyarrow.int64()),
+    ('format', pyarrow.string()),
+    ('DPI', pyarrow.int64()),
+])
+
+BENCHMARK_REPORT_SCHEMA = pyarrow.schema([
+    ('dpi', pyarrow.int64()),
+    ('format', pyarrow.string()),
+    ('quality', pyarrow.int64()),
+    ('workers', pyarrow.int64()),
+    ('nr_pages', pyarrow.int64()),
+    ('pages_per_sec', pyarrow.float64()),
+    ('bytes_per_page', pyarrow.float64()),
+    ('decode_ms_per_page', pyarrow.float64()),
+])
+
+# Schema of the optional per-page timings
+PAGE_TIMINGS_SCHEMA = pyarrow.schema([
+    ('id', pyarrow.string()),
+    ('page_nr', pyarrow.int64()),
+    ('seconds', pyarrow.float64()),
+    # Peak resident set size of the pdftoppm process which rendered the page
+    ('peak_rss_bytes', pyarrow.int64()),
+])
+
+def get_page_file_name(pdf_id: str, page_nr: int, page_count: int, fmt: str) -> str:
+    """Returns the name pdftoppm gives a page, whose number is zero-padded to the number of digits of the page count.
+    See repository.build_page_ids.
+    """
+    return f'{pdf_id}-{str(page_nr).zfill(len(str(page_count)))}.{FORMAT_EXTENSIONS[fmt]}'
+
+class RenderResult(NamedTuple):
+    # Render summary row, see RENDER_SUMMARY_SCHEMA
+    summary_row: dict
+    # Timing rows of the rendered pages, see PAGE_TIMINGS_SCHEMA
+    page_timings: list[dict]
+
+def get_rss_bytes(maxrss: int) -> int:
+    """Converts ru_maxrss of os.wait4 to bytes, since Linux reports KiB and macOS bytes.
+    """
+    return maxrss if sys.platform == 'darwin' else maxrss * 1024
+
+def run_pdftoppm(
+    pdf_path: str,
+    output_prefix: str,
+    first_page: int,
+    last_page: int,
+    dpi: int,
+    fmt: str,
+    quality: Optional[int],
+    processes: int
+) -> list[tuple[int, int, int]]:
+    """Renders pages first_page-last_page of a PDF to output_prefix-<page number>, split evenly between processes
+    pdftoppm processes like pdf2image does. Each process is waited for with os.wait4, which reports its own peak RSS,
+    unlike resource.getrusage, whose peak of all child processes only ever grows.
+
+    Returns:
+        list[tuple[int, int, int]]: First page, last page and peak RSS in bytes of every pdftoppm process.
+    """
+    nr_pages = last_page - first_page + 1
+    processes = max(1, min(processes, nr_pages))
+    running = []
+    for i in range(processes):
+        range_first = first_page + i * nr_pages // processes
+        range_last = first_page + (i + 1) * nr_pages // processes - 1
+        args = ['pdftoppm', '-r', str(dpi), pdf_path, '-f', str(range_first), '-l', str(range_last), f'-{fmt}']
+        if fmt == 'jpeg' and quality is not None:
+            args.extend(['-jpegopt', f'quality={quality}'])
+        args.append(output_prefix)
+        # A file instead of a pipe, so that a process can't block on a full pipe while another one is waited for
+        stderr = tempfile.TemporaryFile()
+        running.append((range_first, range_last, subprocess.Popen(args, stdout=subprocess.DEVNULL, stderr=stderr), stderr))
+
+    results = []
+    errors = []
+    for range_first, range_last, process, stderr in running:
+        _, status, rusage = os.wait4(process.pid, 0)
+        process.returncode = os.waitstatus_to_exitcode(status)
+        with stderr:
+            stderr.seek(0)
+            if process.returncode != 0:
+                errors.append(f'pages {range_first}-{range_last}: {stderr.read().decode(errors="replace").strip()}')
+        results.append((range_first, range_last, get_rss_bytes(rusage.ru_maxrss)))
+    if errors:
+        raise RuntimeError(f'pdftoppm could not render {pdf_path}: {"; ".join(errors)}')
+    return results
+
+def render_pdf(
+    pdf_path: str,
+    output_folder: str,
+    dpi: int = 200,
+    fmt: str = 'png',
+    threads: int = 1,
+    large_pdf_pages: int = 50,
+    force: bool = False,
+    window_pages: Optional[int] = None,
+    quality: Optional[int] = None
+) -> Optional[RenderResult]:
+    """Rasterizes all pages of a PDF into output_folder, skipping pages which have been rendered before.
+
+    Pages are rendered in windows of window_pages pages, or all at once if it is None.
+    A window is skipped if all of its pages exist. Otherwise, its pages are rendered into a temporary folder
+    and moved into output_folder when the window is done, so a page file in output_folder is always complete,
+    and an interrupted PDF continues with its first unfinished window.
+    Windows with at least large_pdf_pages pages are split between threads pdftoppm processes.
+    This only works on files, so it can run in a worker process.
+
+    Args:
+        pdf_path (str): Path of the PDF.
+        output_folder (str): Folder of the page images.
+        dpi (int, optional): Resolution. Defaults to 200.
+        fmt (str, optional): One of FORMAT_EXTENSIONS. Defaults to 'png'.
+        threads (int, optional): Number of pdftoppm processes for large windows. Defaults to 1.
+        large_pdf_pages (int, optional): Page count from which a window counts as large. Defaults to 50.
+        force (bool, optional): Render pages again even if they exist. Defaults to False.
+        window_pages (Optional[int], optional): Number of pages rendered at once. Defaults to all pages.
+        quality (Optional[int], optional): Quality (0-100) of jpeg and webp pages. Defaults to the encoder's default.
+
+    Returns:
+        Optional[RenderResult]: Render summary row and page timings, or None if the PDF has no pages.
+    """
+    pdf_id = os.path.splitext(os.path.basename(pdf_path))[0]
+    page_count = pdfinfo_from_path(pdf_path)['Pages']
+    if page_count < 1:
+        logging.warning(f'{pdf_path} has no pages')
+        return None
+    page_paths = [
+        os.path.join(output_folder, get_page_file_name(pdf_id, page_nr, page_count, fmt))
+        for page_nr in range(1, page_count + 1)
+    ]
 
-    raw_files = [f for f in os.listdir(input_dir) if f.endswith('.pdf')]
-    nr_files = len(raw_files)
+    page_timings = []
+    window_pages = window_pages or page_count
+    render_fmt = 'png' if fmt == 'webp' else fmt
+    for first_page in range(1, page_count + 1, window_pages):
+        last_page = min(first_page + window_pages - 1, page_count)
+        window_paths = page_paths[first_page-1:last_page]
+        if not force and all(os.path.isfile(path) for path in window_paths):
+            logging.debug(f'Skipping pages {first_page}-{last_page} of {pdf_path}, they exist')
+            continue
+
+        start = time.time()
+        tmp_folder = tempfile.mkdtemp(dir=output_folder, prefix=f'.{pdf_id}-')
+        try:
+            process_results = run_pdftoppm(
+                pdf_path,
+                os.path.join(tmp_folder, pdf_id),
+                first_page,
+                last_page,
+                dpi,
+                render_fmt,
+                quality,
+                threads if len(window_paths) >= large_pdf_pages else 1
+            )
+            for page_nr, path in zip(range(first_page, last_page + 1), window_paths):
+                rendered_path = os.path.join(tmp_folder, get_page_file_name(pdf_id, page_nr, page_count, render_fmt))
+                if fmt == 'webp':
+                    converted_path = os.path.join(tmp_folder, os.path.basename(path))
+                    with Image.open(rendered_path) as img:
+                        img.save(converted_path, 'WEBP', **({'quality': quality} if quality is not None else {}))
+                    rendered_path = converted_path
+                os.replace(rendered_path, path)
+        finally:
+            shutil.rmtree(tmp_folder, ignore_errors=True)
+        elapsed_time = time.time() - start
+        # pdftoppm renders a window in one go, so its time is split evenly between its pages
+        page_timings.extend({
+            'id': pdf_id,
+            'page_nr': page_nr,
+            'seconds': elapsed_time / len(window_paths),
+            'peak_rss_bytes': peak_rss_bytes
+        } for range_first, range_last, peak_rss_bytes in process_results for page_nr in range(range_first, range_last + 1))
+        logging.debug(f'Rendered pages {first_page}-{last_page} of {pdf_path} in {elapsed_time:.2f}s, '
+            f'peak RSS of pdftoppm {max(result[2] for result in process_results)} bytes')
+
+    with Image.open(page_paths[0]) as first_page_img:
+        width, height = first_page_img.size
+    return RenderResult({
+        'id': pdf_id,
+        'file': os.path.basename(pdf_path),
+        'page_count': page_count,
+        'width': width,
+        'height': height,
+        'format': fmt,
+        'DPI': dpi
+    }, page_timings)
+
+def write_parquet(rows: list[dict], schema: pyarrow.Schema, path: str):
+    tmp_path = path + '.tmp'
+    pq.write_table(pyarrow.Table.from_pylist(rows, schema=schema), tmp_path)
+    os.replace(tmp_path, path)
+
+def rasterize(
+    input_dir: str,
+    output_folder: str,
+    summary_path: str,
+    dpi: int = 200,
+    fmt: str = 'png',
+    workers: int = 1,
+    threads: int = 1,
+    large_pdf_pages: int = 50,
+    force: bool = False,
+    window_pages: Optional[int] = None,
+    timings_path: Optional[str] = None,
+    quality: Optional[int] = None
+):
+    """Rasterizes all PDFs in input_dir on a process pool and writes their render summary to summary_path.
+    If timings_path is set, the timing of every rendered page and the peak RSS of the pdftoppm process which rendered it
+    are written there.
+    See render_pdf for the other arguments.
+    """
+    pdf_paths = sorted(os.path.join(input_dir, file) for file in os.listdir(input_dir) if file.endswith('.pdf'))
+    nr_files = len(pdf_paths)
+    os.makedirs(output_folder, exist_ok=True)
 
     start = time.time()
+    rows = []
+    page_timings = []
     nr_pages = 0
-    for i, pdf in enumerate(raw_files):
-        input_file = os.path.join(input_dir, pdf)
-        output_file = pdf[:-4]
-        print(f'Input: {input_file}')
-        print(f'Output file: {output_file}')
-        result = convert_from_path(
-            input_file,
-            output_folder=output_folder,
-            fmt='png',
-            output_file=dummygenerator(output_file)
-        )
-        nr_pages += len(result)
-        print(f'Rasterized {i+1}/{nr_files} PDFs.')
-    end = time.time()
+    nr_failed = 0
+    with process_pool(workers) as executor:
+        futures = {executor.submit(render_pdf, path, output_folder, dpi, fmt, threads, large_pdf_pages, force, window_pages, quality): path for path in pdf_paths}
+        for i, (future, path) in enumerate(futures.items()):
+            try:
+                result = future.result()
+            except Exception:
+                logging.exception(f'Could not rasterize {path}')
+                nr_failed += 1
+                continue
+            if result is not None:
+                rows.append(result.summary_row)
+                page_timings.extend(result.page_timings)
+                nr_pages += result.summary_row['page_count']
+            logging.info(f'Rasterized {i+1}/{nr_files} PDFs.')
+    elapsed_time = time.time() - start
+
+    write_parquet(rows, RENDER_SUMMARY_SCHEMA, summary_path)
+    logging.info(f'Wrote the render summary of {len(rows)} PDF(s) to {summary_path}')
+    if timings_path is not None:
+        write_parquet(page_timings, PAGE_TIMINGS_SCHEMA, timings_path)
+        if page_timings:
+            logging.info(f'Wrote the timings of {len(page_timings)} rendered page(s) to {timings_path}, '
+                f'slowest page took {max(timing["seconds"] for timing in page_timings):.2f}s, '
+                f'largest peak RSS of pdftoppm was {max(timing["peak_rss_bytes"] for timing in page_timings)} bytes')
+    if nr_failed:
+        logging.error(f'{nr_failed} PDF(s) could not be rasterized')
+    if nr_pages:
+        logging.info(f'Rasterized {nr_pages} pages in {elapsed_time/60} minutes, at an avg. of {elapsed_time/nr_pages}s per page.')
+
+class BenchmarkResult(NamedTuple):
+    dpi: int
+    format: str
+    quality: Optional[int]
+    workers: int
+    nr_pages: int
+    pages_per_sec: float
+    bytes_per_page: float
+    # Time helpers.crop_all_to_content takes per page, which is dominated by decoding the image
+    decode_ms_per_page: float
+
+def get_decode_ms_per_page(page_paths: list[str]) -> float:
+    """Measures how long helpers.crop_all_to_content takes to decode a page and crop a box spanning the whole page.
+    """
+    elapsed_time = 0.0
+    for path in page_paths:
+        with open(path, 'rb') as file:
+            data = file.read()
+        with Image.open(path) as img:
+            width, height = img.size
+        page_box = AbsoluteBoundingBox(TargetType.FIGURE.value, 0, 0, height - 1, width - 1, None)
+        start = time.perf_counter()
+        helpers.crop_all_to_content(data, [page_box])
+        elapsed_time += time.perf_counter() - start
+    return 1000 * elapsed_time / len(page_paths) if page_paths else 0.0
 
-    elapsed_time = end - start
+def benchmark(
+    input_dir: str,
+    scratch_folder: str,
+    dpis: list[int],
+    formats: list[str],
+    qualities: list[Optional[int]],
+    worker_counts: list[int],
+    threads: int = 1,
+    large_pdf_pages: int = 50,
+    decode_sample_size: int = 50,
+    report_path: Optional[str] = None
+) -> list[BenchmarkResult]:
+    """Rasterizes all PDFs in input_dir once per combination of settings and measures the throughput,
+    the size of the pages and how long they take to decode during evaluation.
+    Qualities only apply to jpeg and webp. The pages of each run are rendered into scratch_folder and deleted afterwards.
 
-    print(f'Rasterized {nr_pages} pages in {elapsed_time/60} minutes, at an avg. of {elapsed_time/nr_pages}s per page.')
-    
-    
-    
\ No newline at end of file
+    Args:
+        input_dir (str): Folder with the PDFs of the corpus.
+        scratch_folder (str): Folder for the pages rendered during the benchmark.
+        dpis (list[int]): Resolutions to test.
+        formats (list[str]): Formats to test, see FORMAT_EXTENSIONS.
+        qualities (list[Optional[int]]): Qualities to test for jpeg and webp.
+        worker_counts (list[int]): Numbers of worker processes to test.
+        threads (int, optional): See render_pdf. Defaults to 1.
+        large_pdf_pages (int, optional): See render_pdf. Defaults to 50.
+        decode_sample_size (int, optional): Max. number of pages whose decode time is measured per run. Defaults to 50.
+        report_path (Optional[str], optional): Path of a parquet file for the results. Defaults to None.
+
+    Returns:
+        list[BenchmarkResult]: One result per combination of settings.
+    """
+    pdf_paths = sorted(os.path.join(input_dir, file) for file in os.listdir(input_dir) if file.endswith('.pdf'))
+    results = []
+    for dpi, fmt, workers in itertools.product(dpis, formats, worker_counts):
+        for quality in (qualities if fmt in ('jpeg', 'webp') else [None]):
+            run_folder = tempfile.mkdtemp(dir=scratch_folder, prefix='benchmark-')
+            try:
+                start = time.time()
+                with process_pool(workers) as executor:
+                    futures = [executor.submit(render_pdf, path, run_folder, dpi, fmt, threads, large_pdf_pages, True, None, quality) for path in pdf_paths]
+                    renders = [future.result() for future in futures]
+                elapsed_time = time.time() - start
+
+                page_paths = [os.path.join(run_folder, file) for file in sorted(os.listdir(run_folder)) if not file.startswith('.')]
+                nr_pages = sum(render.summary_row['page_count'] for render in renders if render is not None)
+                nr_bytes = sum(os.path.getsize(path) for path in page_paths)
+                sample = page_paths[::max(1, len(page_paths) // decode_sample_size)][:decode_sample_size]
+                result = BenchmarkResult(
+                    dpi,
+                    fmt,
+                    quality,
+                    workers,
+                    nr_pages,
+                    nr_pages / elapsed_time if elapsed_time else 0.0,
+                    nr_bytes / nr_pages if nr_pages else 0.0,
+                    get_decode_ms_per_page(sample)
+                )
+            finally:
+                shutil.rmtree(run_folder, ignore_errors=True)
+            logging.info(f'DPI {dpi}, {fmt}, quality {quality}, {workers} worker(s): {result.pages_per_sec:.2f} pages/s, '
+                f'{result.bytes_per_page / 1024:.1f} KiB/page, {result.decode_ms_per_page:.2f} ms decode/page')
+            results.append(result)
+
+    if report_path is not None:
+        write_parquet([result._asdict() for result in results], BENCHMARK_REPORT_SCHEMA, report_path)
+        logging.info(f'Wrote the benchmark report to {report_path}')
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Rasterize PDFs into page images and write a render summary for the ingest command of manage_HITs.py')
+    parser.add_argument('input_dir', metavar='INPUT_DIR', help='Folder with the PDFs')
+    parser.add_argument('output_folder', metavar='OUTPUT_FOLDER', help='Folder for the page images')
+    parser.add_argument('--summary', '-s', help='Path of the render summary parquet file (default is OUTPUT_FOLDER/render_summary.parquet)')
+    parser.add_argument('--dpi', '-d', help='Resolution of the page images (default is 200)', type=int, default=200)
+    parser.add_argument('--format', '-f', help='Format of the page images (default is png)', choices=list(FORMAT_EXTENSIONS.keys()), default='png')
+    parser.add_argument('--workers', '-w', help='Number of PDFs rasterized in parallel (default is the number of CPUs)', type=int, default=os.cpu_count())
+    parser.add_argument('--threads', '-t', help='Number of pdftoppm processes per large PDF (default is 1)', type=int, default=1)
+    parser.add_argument('--large-pdf-pages', help='Page count from which a PDF is split between --threads processes (default is 50)', type=int, default=50)
+    parser.add_argument('--force', action='store_true', help='Rasterize pages again even if they exist')
+    parser.add_argument('--window-pages', help='Render at most this many pages of a PDF at once, to bound the resources per PDF (default is all pages)', type=int)
+    parser.add_argument('--timings', help='Path of a parquet file for the timing of every rendered page and the peak RSS of the pdftoppm process which rendered it')
+    parser.add_argument('--quality', '-q', help='Quality (0-100) of jpeg and webp pages', type=int)
+    benchmark_group = parser.add_argument_group(
+        'benchmark',
+        'Rasterize INPUT_DIR once per combination of the settings below, using OUTPUT_FOLDER as scratch space, and report '
+        'pages/s, bytes per page and decode time per page instead of rasterizing for ingest'
+    )
+    benchmark_group.add_argument('--benchmark', action='store_true', help='Run the benchmark')
+    benchmark_group.add_argument('--benchmark-dpis', metavar='DPI', nargs='+', type=int, default=[100, 150, 200], help='Default is 100 150 200')
+    benchmark_group.add_argument('--benchmark-formats', metavar='FORMAT', nargs='+', choices=list(FORMAT_EXTENSIONS.keys()), default=['png', 'jpeg', 'webp'], help='Default is png jpeg webp')
+    benchmark_group.add_argument('--benchmark-qualities', metavar='QUALITY', nargs='+', type=int, default=[75, 90], help='Qualities of jpeg and webp, default is 75 90')
+    benchmark_group.add_argument('--benchmark-workers', metavar='WORKERS', nargs='+', type=int, default=[os.cpu_count()], help='Default is the number of CPUs')
+    benchmark_group.add_argument('--benchmark-decode-pages', type=int, default=50, help='Max. number of pages whose decode time is measured per run, default is 50')
+    benchmark_group.add_argument('--benchmark-report', help='Path of a parquet file for the benchmark results')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+    if args.benchmark:
+        os.makedirs(args.output_folder, exist_ok=True)
+        benchmark(
+            args.input_dir,
+            args.output_folder,
+            args.benchmark_dpis,
+            args.benchmark_formats,
+            args.benchmark_qualities,
+            args.benchmark_workers,
+            args.threads,
+            args.large_pdf_pages,
+            args.benchmark_decode_pages,
+            args.benchmark_report
+        )
+        sys.exit()
+    rasterize(
+        args.input_dir,
+        args.output_folder,
+        args.summary or os.path.join(args.output_folder, 'render_summary.parquet'),
+        args.dpi,
+        args.format,
+        args.workers,
+        args.threads,
+        args.large_pdf_pages,
+        args.force,
+        args.window_pages,
+        args.timings,
+        args.quality
+    )
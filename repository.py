@@ -1,19 +1,46 @@
-from collections import namedtuple
+from collections import namedtuple, Counter
+from datetime import datetime, timedelta
 from distutils.command.config import config
-from typing import Any, NamedTuple
+from typing import Any, Callable, Iterable, NamedTuple, Optional
+import uuid
 from pymongo.database import Database
+from pymongo.collection import Collection
+from pymongo.cursor import Cursor
+from pymongo.client_session import ClientSession
+from pymongo.errors import BulkWriteError, OperationFailure
 from config import Config
-from pymongo import MongoClient, DESCENDING, ASCENDING, UpdateOne
-import pandas
+from pymongo import MongoClient, DESCENDING, ASCENDING, UpdateOne, IndexModel
+import pyarrow
 import logging
 from enums.assignment_status import AssignmentStatus
 from enums.page_status import PageStatus
 from enums.qualification_types import QualificationType
 import os
-import urllib.request
+import tempfile
+import threading
+from concurrent.futures import Future
+import urllib3
 import numpy as np
+from byte_lru_cache import ByteLRUCache
 
 QUAL_TYPE_CACHE = {}
+DUPLICATE_KEY_ERROR_CODE = 11000
+# Raw (encoded) page rasters, keyed by page ID
+IMAGE_CACHE = ByteLRUCache('Image', int(Config.get_or_default('image_cache_max_bytes', 256 * 1024**2)))
+# Shared by all image downloads so that connections to image_url_base are reused
+HTTP_POOL = urllib3.PoolManager(maxsize=16, retries=urllib3.Retry(total=3, backoff_factor=0.5))
+# Downloads which are currently running, keyed by page ID
+DOWNLOADS_IN_FLIGHT: dict[str, Future] = {}
+DOWNLOAD_LOCK = threading.Lock()
+
+def _get_new_file_mode() -> int:
+    umask = os.umask(0)
+    os.umask(umask)
+    return 0o666 & ~umask
+
+# Mode open() gives new files. Files written through tempfile.mkstemp get it as well, since mkstemp creates them with 0600.
+# Read once at import, since reading the umask briefly changes it for all threads.
+NEW_FILE_MODE = _get_new_file_mode()
 
 class DB:
     __instance: Database
@@ -30,52 +57,290 @@ class DB:
             )[Config.get('mongodb_db_name')]
             return DB.__instance
 
-def ingest_pdfs(data: pandas.DataFrame):
-    """Ingests a render summary dataframe into the collection pages and pdfs
-    
+# Holds the session of the transaction started by run_in_transaction on the current thread
+TRANSACTION_STATE = threading.local()
+# Whether the deployment supports transactions, checked on first use
+TRANSACTIONS_SUPPORTED: Optional[bool] = None
+
+def _session() -> Optional[ClientSession]:
+    """Returns the session of the transaction running on this thread, which the functions in this module pass to the DB.
+    """
+    return getattr(TRANSACTION_STATE, 'session', None)
+
+def supports_transactions() -> bool:
+    """Transactions need a replica set or a sharded cluster.
+    """
+    global TRANSACTIONS_SUPPORTED
+    if TRANSACTIONS_SUPPORTED is None:
+        try:
+            hello = DB.get().command('isMaster')
+            TRANSACTIONS_SUPPORTED = 'setName' in hello or hello.get('msg') == 'isdbgrid'
+        except (OperationFailure, NotImplementedError):
+            TRANSACTIONS_SUPPORTED = False
+        if not TRANSACTIONS_SUPPORTED:
+            logging.warning('The DB does not support transactions, so related writes are not applied atomically')
+    return TRANSACTIONS_SUPPORTED
+
+def run_in_transaction(func: Callable[[], Any]) -> Any:
+    """Calls func, and runs everything the functions in this module read and write on this thread during the call
+    in one transaction. The transaction is retried on transient errors, so func may be called more than once.
+    Without transaction support (a standalone server), func is simply called.
+
+    Returns:
+        Any: The return value of func.
+    """
+    if _session() is not None or not supports_transactions():
+        return func()
+    with DB.get().client.start_session() as session:
+        TRANSACTION_STATE.session = session
+        try:
+            return session.with_transaction(lambda _: func())
+        finally:
+            TRANSACTION_STATE.session = None
+
+# Indexes matching the access paths of the queries in this module, per collection
+INDEXES: dict[str, list[IndexModel]] = {
+    'pages': [
+        # get_random_pages_by_status, get_accepted_assignments
+        IndexModel([('status', ASCENDING), ('group', ASCENDING)], name='status_group'),
+        # get_accepted_assignments(only_unexported=True)
+        IndexModel([('status', ASCENDING), ('group', ASCENDING), ('exported_at', ASCENDING)], name='status_group_exported_at'),
+        # get_assignment, update_pages_from_tuples
+        IndexModel([('assignments.assignment_id', ASCENDING)], name='assignment_id'),
+        # get_qualification_pages
+        IndexModel([('qualification_page', ASCENDING)], name='qualification_page', sparse=True),
+        # get_submitted_pages_by_HIT_ids
+        IndexModel([('HIT_ids', ASCENDING)], name='HIT_ids'),
+    ],
+    'workers': [
+        # find_workers_in_point_range, count_workers_in_point_range. With _id, queries for worker IDs are covered by the index.
+        IndexModel([('env', ASCENDING), ('verification_points', ASCENDING), ('_id', ASCENDING)], name='env_verification_points_id'),
+        # find_workers_in_point_range(points_field='qual_points_total')
+        IndexModel([('env', ASCENDING), ('qual_points_total', ASCENDING), ('_id', ASCENDING)], name='env_qual_points_total_id'),
+        # get_workers_for_qual_sync
+        IndexModel([('qual_sync_pending', ASCENDING)], name='qual_sync_pending', sparse=True),
+    ],
+    'mturk_outbox': [
+        # claim_outbox_entries
+        IndexModel([('status', ASCENDING), ('next_attempt_at', ASCENDING)], name='status_next_attempt_at'),
+        # Deletes done entries after 30 days. An assignment whose entry was deleted can be queued again,
+        # but MTurk rejects a second approval or rejection, which only marks the new entry as failed.
+        IndexModel([('done_at', ASCENDING)], name='done_at_ttl', expireAfterSeconds=30 * 24 * 3600),
+    ],
+    'hit_types': [
+        # get_active_hit_type_or_by_id
+        IndexModel([('environment', ASCENDING), ('active', ASCENDING)], name='environment_active'),
+    ],
+    'qual_requirements': [
+        # get_qual_type_id
+        IndexModel([('env', ASCENDING), ('Name', ASCENDING)], name='env_name'),
+    ],
+}
+
+# Indexes which were replaced by ones in INDEXES, per collection
+OBSOLETE_INDEXES: dict[str, list[str]] = {
+    # Replaced by env_verification_points_id
+    'workers': ['env_verification_points'],
+}
+
+def ensure_indexes():
+    """Creates all indexes in INDEXES which don't exist yet, and drops those in OBSOLETE_INDEXES.
+    """
+    for collection, indexes in INDEXES.items():
+        created = DB.get()[collection].create_indexes(indexes)
+        logging.debug(f'Indexes of collection {collection}: {created}')
+    for collection, index_names in OBSOLETE_INDEXES.items():
+        existing = DB.get()[collection].index_information().keys()
+        for index_name in index_names:
+            if index_name in existing:
+                DB.get()[collection].drop_index(index_name)
+                logging.info(f'Dropped obsolete index {collection}.{index_name}')
+
+def get_missing_indexes() -> list[str]:
+    """Returns the names of indexes in INDEXES which don't exist, in the form collection.index_name.
+    """
+    missing = []
+    for collection, indexes in INDEXES.items():
+        existing = DB.get()[collection].index_information().keys()
+        missing.extend(f'{collection}.{index.document["name"]}' for index in indexes if index.document['name'] not in existing)
+    return missing
+
+def get_query_shapes() -> dict[str, tuple[str, dict]]:
+    """Returns representative filters of the queries in this module, as {query name: (collection, filter)}.
+    """
+    env = Config.get('env_name')
+    group_filter = {'group': {'$in': Config.get('active_page_groups')}} if Config.get('active_page_groups') else {}
+    return {
+        'get_random_pages_by_status': ('pages', {'status': {'$in': [PageStatus.DEFERRED.value]}, **group_filter}),
+        'get_accepted_assignments': ('pages', {
+            'status': {'$in': [PageStatus.REVIEWED.value, PageStatus.VERIFIED.value]},
+            **group_filter,
+            'exported_at': {'$exists': False}
+        }),
+        'get_assignment': ('pages', {'_id': '', 'assignments.assignment_id': ''}),
+        'get_qualification_pages': ('pages', {'qualification_page': {'$exists': True, '$eq': True}}),
+        'get_submitted_pages_by_HIT_ids': ('pages', {'HIT_ids': {'$in': ['']}, 'status': PageStatus.SUBMITTED.value}),
+        'find_workers_in_point_range': ('workers', _worker_point_range_filter(0, None, True, 'verification_points')),
+        'find_workers_in_point_range_total': ('workers', _worker_point_range_filter(0, None, True, 'qual_points_total')),
+        'get_workers_for_qual_sync': ('workers', {'qual_sync_pending': {'$exists': True}}),
+        'claim_outbox_entries': ('mturk_outbox', {'status': 'pending', 'next_attempt_at': {'$lte': datetime.now()}}),
+        'get_active_hit_type_or_by_id': ('hit_types', {'active': True, 'environment': env}),
+        'get_qual_type_id': ('qual_requirements', {'Name': '', 'env': env}),
+    }
+
+def get_collection_scan_queries() -> list[str]:
+    """Explains every query in get_query_shapes and returns the names of those which would scan a whole collection.
+    """
+    def has_collection_scan(plan) -> bool:
+        if isinstance(plan, dict):
+            return plan.get('stage') == 'COLLSCAN' or any(has_collection_scan(value) for value in plan.values())
+        if isinstance(plan, list):
+            return any(has_collection_scan(value) for value in plan)
+        return False
+
+    scanning = []
+    for name, (collection, filter) in get_query_shapes().items():
+        explanation = DB.get()[collection].find(filter).explain()
+        if has_collection_scan(explanation['queryPlanner']['winningPlan']):
+            scanning.append(name)
+    return scanning
+
+def ingest_pdfs(
+    batches: Iterable[pyarrow.RecordBatch],
+    chunk_size: int = 10000,
+    upsert: bool = False,
+    checkpoint_id: Optional[str] = None
+) -> dict[str, Counter]:
+    """Ingests a render summary into the collections pages and pdfs, one record batch at a time.
+    Pages are inserted in chunks of chunk_size, so memory use doesn't depend on the size of the input.
+
+    In upsert mode, documents which already exist are left untouched instead of causing write errors,
+    which makes the ingest idempotent.
+    If a checkpoint_id is provided, the number of finished batches is saved in the ingest_checkpoints collection
+    after each batch, and a later call with the same checkpoint_id skips them.
+    The checkpoint is deleted once all batches are done, so that ingesting the same file again starts from the beginning.
  
     Args:
-        data (pandas.DataFrame): Dataframe with the following shape:
-            #   Column  Dtype \n
-            ---  ------  ----- \n
-            0   file    object\n
-            1   page_nr int64 \n
-            2   width   int64 \n
-            3   height  int64 \n
-            4   format  object\n
-            5   DPI     int64\n
-
-            Where only file and page_nr are required fields.
+        batches (Iterable[pyarrow.RecordBatch]): Record batches with the following schema:
+            #   Column      Dtype \n
+            ---  ------      ----- \n
+            0   id          string\n
+            1   file        string\n
+            2   page_count  int64 \n
+            3   width       int64 \n
+            4   height      int64 \n
+            5   format      string\n
+            6   DPI         int64\n
+
+            Where only id, file and page_count are required fields.
             Any extra columns are allowed and simply passed to the database.
-    """     
-    pdf_list = []
-    page_list = []
-
-    for index, row in data.iterrows():
-        logging.debug(f'Ingesting row: {str(index)}')
-        id = row.id
-        fields = row.to_dict()
-        fields.pop('id')
-
-        pdf_list.append({
-            '_id': id,
-            **fields
-        })
-        
-        # This is to handle the dumb way pdftoppm names files: 
-        # https://gitlab.freedesktop.org/poppler/poppler/-/issues/1172
-        nr_digits = len(str(fields['page_count']))
-        pages = [{
-            '_id': '%s-%0*d' % (id, nr_digits, page_nr),
-            'status': PageStatus.NOT_ANNOTATED.value,
-            'pdf_id': fields['file']
-        } for page_nr in range(1, fields['page_count']+1)]
-        page_list.extend(pages)
-
-    logging.debug(f'Inserting {len(pdf_list)} pdfs into the DB...')
-    DB.get().pdfs.insert_many(pdf_list, ordered=False)
-    logging.debug(f'Inserting {len(page_list)} pages into the DB...')
-    DB.get().pages.insert_many(page_list, ordered=False)
+        chunk_size (int, optional): Max. number of pages inserted at once. Defaults to 10000.
+        upsert (bool, optional): Skip existing documents instead of failing on them. Defaults to False.
+        checkpoint_id (Optional[str], optional): ID of the checkpoint used to resume the ingest. Defaults to None.
+
+    Returns:
+        dict[str, Counter]: Number of inserted, existing and failed documents per collection.
+    """
+    report = {'pdfs': Counter(), 'pages': Counter()}
+    nr_done_batches = 0
+    if checkpoint_id is not None:
+        checkpoint = DB.get().ingest_checkpoints.find_one({'_id': checkpoint_id})
+        if checkpoint:
+            nr_done_batches = checkpoint['batches_done']
+            report = {collection: Counter(counts) for collection, counts in checkpoint['report'].items()}
+            logging.info(f'Resuming ingest from checkpoint {checkpoint_id} after {nr_done_batches} batch(es)')
+
+    for batch_nr, batch in enumerate(batches):
+        if batch_nr < nr_done_batches:
+            continue
+
+        pdf_list = batch.to_pylist()
+        for pdf in pdf_list:
+            pdf['_id'] = pdf.pop('id')
+        logging.debug(f'Inserting {len(pdf_list)} pdfs into the DB...')
+        report['pdfs'] += _insert_documents(DB.get().pdfs, pdf_list, upsert)
+
+        page_ids, pdf_files = build_page_ids(batch)
+        logging.debug(f'Inserting {len(page_ids)} pages into the DB...')
+        for i in range(0, len(page_ids), chunk_size):
+            counts = _insert_documents(DB.get().pages, [{
+                '_id': page_id,
+                'status': PageStatus.NOT_ANNOTATED.value,
+                'pdf_id': pdf_file
+            } for page_id, pdf_file in zip(page_ids[i:i+chunk_size], pdf_files[i:i+chunk_size])], upsert)
+            _increment_stats(Counter({_page_stats_key(PageStatus.NOT_ANNOTATED.value, None): counts['inserted']}))
+            report['pages'] += counts
+
+        if checkpoint_id is not None:
+            DB.get().ingest_checkpoints.replace_one(
+                {'_id': checkpoint_id},
+                {'batches_done': batch_nr + 1, 'report': {collection: dict(counts) for collection, counts in report.items()}},
+                upsert=True
+            )
+        logging.debug(f'Ingested batch {batch_nr}: {report}')
+
+    if checkpoint_id is not None:
+        delete_ingest_checkpoint(checkpoint_id)
+    return report
+
+def _insert_documents(collection: Collection, documents: list[dict], upsert: bool) -> Counter:
+    """Inserts documents in one unordered bulk write, and counts how many were inserted, already existed or failed.
+    """
+    counts = Counter()
+    if not documents:
+        return counts
+
+    try:
+        if upsert:
+            result = collection.bulk_write([UpdateOne(
+                {'_id': doc['_id']},
+                {'$setOnInsert': {key: value for key, value in doc.items() if key != '_id'}},
+                upsert=True
+            ) for doc in documents], ordered=False)
+            counts['inserted'] += result.upserted_count
+            counts['existing'] += result.matched_count
+        else:
+            result = collection.insert_many(documents, ordered=False)
+            counts['inserted'] += len(result.inserted_ids)
+    except BulkWriteError as e:
+        details = e.details
+        counts['inserted'] += details.get('nUpserted', 0) if upsert else details.get('nInserted', 0)
+        counts['existing'] += details.get('nMatched', 0)
+        for error in details['writeErrors']:
+            if error['code'] == DUPLICATE_KEY_ERROR_CODE:
+                counts['existing'] += 1
+            else:
+                counts['failed'] += 1
+                logging.error(f'Could not insert document into {collection.name}: {error["errmsg"]}')
+    return counts
+
+def delete_ingest_checkpoint(checkpoint_id: str):
+    DB.get().ingest_checkpoints.delete_one({'_id': checkpoint_id})
+
+def build_page_ids(batch: pyarrow.RecordBatch) -> tuple[list[str], list[str]]:
+    """Builds the IDs of all pages of the PDFs in a record batch, along with the file of the PDF each page belongs to.
+
+    Page numbers are zero-padded to the number of digits of the page count,
+    which is the dumb way pdftoppm names files: https://gitlab.freedesktop.org/poppler/poppler/-/issues/1172
+
+    Returns:
+        tuple[list[str], list[str]]: Page IDs and PDF files.
+    """
+    page_counts = np.maximum(batch.column('page_count').to_numpy(zero_copy_only=False).astype(np.int64), 0)
+    pdf_ids = batch.column('id').to_numpy(zero_copy_only=False).astype(str)
+    pdf_files = batch.column('file').to_numpy(zero_copy_only=False)
+
+    # Page numbers restart at 1 for each PDF
+    first_page_idx = np.repeat(np.cumsum(page_counts) - page_counts, page_counts)
+    page_nrs = (np.arange(page_counts.sum()) - first_page_idx + 1).astype(str)
+    nr_digits = np.repeat(np.char.str_len(page_counts.astype(str)), page_counts)
+    padded_page_nrs = np.empty_like(page_nrs, dtype=f'<U{max(nr_digits.max(initial=1), 1)}')
+    for width in np.unique(nr_digits):
+        mask = nr_digits == width
+        padded_page_nrs[mask] = np.char.zfill(page_nrs[mask], width)
+
+    page_ids = np.char.add(np.char.add(np.repeat(pdf_ids, page_counts), '-'), padded_page_nrs)
+    return page_ids.tolist(), np.repeat(pdf_files, page_counts).tolist()
 
 def save_hit_type(params: dict):
     if(params['active']):
@@ -97,7 +362,7 @@ def get_active_hit_type_or_by_id(id: str=None)-> dict:
 
 def update_pages_to_submitted(page_HIT_id_map: dict):
     if page_HIT_id_map:
-        update_operations = [UpdateOne(
+        bulk_results = _write_page_updates([(
             {"_id": page_id},
             {  
                 "$set": {'status': PageStatus.SUBMITTED.value}, 
@@ -106,8 +371,7 @@ def update_pages_to_submitted(page_HIT_id_map: dict):
                     'published': response['HIT']['CreationTime']
                 }
             }
-        ) for page_id, response in page_HIT_id_map.items()]
-        bulk_results = DB.get().pages.bulk_write(update_operations)
+        ) for page_id, response in page_HIT_id_map.items()])
 
         logging.debug(f'Updated: {bulk_results.modified_count} document(s)')
 
@@ -120,18 +384,17 @@ def update_assignment_statuses_from_dict(page_id: str, assignment_id_status_dict
             array_filters=[{'assig.assignment_id': {'$eq': assignment_id}}],
             upsert=True
         ) for assignment_id, status in assignment_id_status_dict.items()]
-        bulk_results = DB.get().pages.bulk_write(update_operations)
+        bulk_results = DB.get().pages.bulk_write(update_operations, session=_session())
         logging.debug(f'update_assignment_statuses_from_dict updated: {bulk_results.modified_count} document(s)')
         logging.debug(f'update_assignment_statuses_from_dict raw: {bulk_results.bulk_api_result}')
         return bulk_results
 
 def update_pages_from_dict(page_id_ops_dict: dict):
     if page_id_ops_dict:
-        update_operations = [UpdateOne(
+        bulk_results = _write_page_updates([(
             {'_id': page_id},
             operations
-        ) for page_id, operations in page_id_ops_dict.items()]
-        bulk_results = DB.get().pages.bulk_write(update_operations)
+        ) for page_id, operations in page_id_ops_dict.items()])
         logging.debug(f'update_pages_from_dict updated: {bulk_results.modified_count} document(s)')
         return bulk_results
 
@@ -140,18 +403,139 @@ def update_pages_from_tuples(filter_actions_list: list[tuple]):
     """
         Updates pages by using the first entry in each tuple as a filter, and the second one as the action.
     """
-    update_operations = [UpdateOne(
-        filters,
-        actions
-    ) for filters, actions in filter_actions_list]
-    if len(update_operations):
-        bulk_results = DB.get().pages.bulk_write(update_operations)
+    if len(filter_actions_list):
+        bulk_results = _write_page_updates(filter_actions_list)
         logging.debug(f'Updated: {bulk_results.modified_count} document(s)')
         return bulk_results
     else:
         logging.debug('No update operations provided')
         return None
 
+class WriteResult(NamedTuple):
+    matched_count: int
+    modified_count: int
+
+class TrackedUpdate(NamedTuple):
+    """An update of one document whose tracked fields (e.g. the status of a page) feed the stats, see _write_tracked_updates.
+    """
+    filter: dict
+    update: Any
+    # Tracked fields before the update (None for a document created by it) -> tracked fields after it
+    get_new_fields: Callable[[Optional[dict]], dict]
+
+def _write_tracked_updates(
+    collection: str,
+    tracked_fields: list[str],
+    tracked_updates: list[TrackedUpdate],
+    other_operations: list[UpdateOne],
+    upsert: bool = False,
+    max_rounds: int = 3
+) -> tuple[WriteResult, list[tuple[Optional[dict], dict]]]:
+    """Writes updates in one bulk write, and returns the changes of the tracked fields which the writes made.
+
+    The tracked fields of all documents are read at once, and every update is made conditional on the values it read,
+    so that the returned changes are those the write itself made. Updates which didn't match because the document
+    changed in the meantime are read and written again, up to max_rounds times. Updates which didn't match although
+    the document didn't change are dropped, since the rest of their filter doesn't match.
+
+    Args:
+        collection (str): Name of the collection.
+        tracked_fields (list[str]): Fields whose changes are returned.
+        tracked_updates (list[TrackedUpdate]): Updates whose filter contains _id.
+        other_operations (list[UpdateOne]): Updates whose changes aren't tracked, written in the first bulk write.
+        upsert (bool, optional): Create the documents of tracked updates which don't exist. Defaults to False.
+        max_rounds (int, optional): Max. number of bulk writes. Defaults to 3.
+
+    Returns:
+        tuple[WriteResult, list[tuple[Optional[dict], dict]]]: Counts of all bulk writes,
+            and (tracked fields before, tracked fields after) of every document the tracked updates changed.
+    """
+    projection = {field: 1 for field in tracked_fields}
+    matched_count = modified_count = 0
+    changes = []
+    for attempt in range(max_rounds):
+        old_docs = {doc['_id']: doc for doc in DB.get()[collection].find(
+            {'_id': {'$in': [tracked.filter['_id'] for tracked in tracked_updates]}},
+            projection,
+            session=_session()
+        )} if tracked_updates else {}
+        written = []
+        update_operations = list(other_operations) if attempt == 0 else []
+        for tracked in tracked_updates:
+            old_doc = old_docs.get(tracked.filter['_id'])
+            if old_doc is None and not upsert:
+                continue
+            if old_doc is None:
+                update_operations.append(UpdateOne(tracked.filter, tracked.update, upsert=True))
+            else:
+                update_operations.append(UpdateOne(
+                    {**tracked.filter, **{field: old_doc.get(field) for field in tracked_fields}},
+                    tracked.update
+                ))
+            written.append((tracked, old_doc))
+        if not update_operations:
+            break
+        bulk_results = DB.get()[collection].bulk_write(update_operations, session=_session())
+        matched_count += bulk_results.matched_count
+        modified_count += bulk_results.modified_count
+        if bulk_results.matched_count + bulk_results.upserted_count == len(update_operations):
+            changes.extend((old_doc, tracked.get_new_fields(old_doc)) for tracked, old_doc in written)
+            return WriteResult(matched_count, modified_count), changes
+
+        # Some updates didn't match, find out which ones from the fields they would have written
+        current_docs = {doc['_id']: doc for doc in DB.get()[collection].find(
+            {'_id': {'$in': [tracked.filter['_id'] for tracked, old_doc in written]}},
+            projection,
+            session=_session()
+        )}
+        tracked_updates = []
+        for tracked, old_doc in written:
+            current_doc = current_docs.get(tracked.filter['_id'], {})
+            new_fields = tracked.get_new_fields(old_doc)
+            current_fields = {field: current_doc.get(field) for field in tracked_fields}
+            if current_fields == {field: new_fields.get(field) for field in tracked_fields}:
+                changes.append((old_doc, new_fields))
+            elif old_doc is not None and current_fields != {field: old_doc.get(field) for field in tracked_fields}:
+                tracked_updates.append(tracked)
+        if not tracked_updates:
+            break
+    else:
+        logging.warning(f'{len(tracked_updates)} update(s) of {collection} kept conflicting with other writes and were '
+            f'not written, e.g. {tracked_updates[0].filter}')
+    return WriteResult(matched_count, modified_count), changes
+
+def _write_page_updates(filter_update_pairs: list[tuple[dict, dict]]) -> WriteResult:
+    """Writes (filter, update) pairs to pages, and applies the resulting status changes to the stats.
+    Setting the status also removes the exported_at marker, so that the page is exported again, see mark_pages_exported.
+    Status changes can only be tracked for filters on _id, see _write_tracked_updates.
+    """
+    tracked_updates = []
+    other_operations = []
+    for filter, update in filter_update_pairs:
+        new_status = update.get('$set', {}).get('status')
+        if new_status is None:
+            other_operations.append(UpdateOne(filter, update))
+            continue
+        update = {**update, '$unset': {**update.get('$unset', {}), 'exported_at': ''}}
+        if '_id' not in filter:
+            logging.warning(f'Status change of pages matching {filter} is not reflected in the stats, run recompute-stats')
+            other_operations.append(UpdateOne(filter, update))
+            continue
+        tracked_updates.append(TrackedUpdate(
+            filter,
+            update,
+            lambda old_page, new_status=new_status: {'status': new_status, 'group': old_page.get('group')}
+        ))
+
+    write_result, changes = _write_tracked_updates('pages', ['status', 'group'], tracked_updates, other_operations)
+    deltas = Counter()
+    for old_page, new_page in changes:
+        if old_page.get('status') != new_page['status']:
+            deltas[_page_stats_key(old_page.get('status'), old_page.get('group'))] -= 1
+            deltas[_page_stats_key(new_page['status'], new_page['group'])] += 1
+    _increment_stats(deltas)
+    return write_result
+
 def get_random_pages_by_status(statuses: list[PageStatus], count: int = None, id_only: bool = False) -> list:
     aggregation_pipeline: list[dict[str, Any]] = [{
         '$match': {
@@ -184,6 +568,19 @@ def get_random_pages_by_status(statuses: list[PageStatus], count: int = None, id
     else:
         raise LookupError(f'There are no more pages in any of these statuses: {[status.value for status in statuses]}!')
 
+def get_submitted_pages_by_HIT_ids(HIT_ids: list[str], chunk_size: int = 1000):
+    """Yields submitted pages which have any of the given HIT IDs in their HIT_ids field.
+    Only the _id and HIT_ids fields are returned.
+    """
+    for i in range(0, len(HIT_ids), chunk_size):
+        yield from DB.get().pages.find(
+            {
+                'HIT_ids': {'$in': HIT_ids[i:i+chunk_size]},
+                'status': PageStatus.SUBMITTED.value
+            },
+            {'HIT_ids': 1}
+        )
+
 def get_pages_in_id_list(ids: list[str]) -> list[dict]:
     result = []
     if ids:
@@ -191,7 +588,7 @@ def get_pages_in_id_list(ids: list[str]) -> list[dict]:
     return list(result)
 
 def get_page_by_id(id: str) -> dict:
-    result = DB.get().pages.find_one({'_id': id})
+    result = DB.get().pages.find_one({'_id': id}, session=_session())
     logging.debug(f'get_page_by_id result: {result}')
 
     if result:
@@ -202,7 +599,8 @@ def get_page_by_id(id: str) -> dict:
 def get_assignment(page_id: str, assignment_id: str):
     result = DB.get().pages.find_one(
         {'_id': page_id, 'assignments.assignment_id': assignment_id},
-        {"assignments": {'$elemMatch': {'assignment_id': assignment_id}}}
+        {"assignments": {'$elemMatch': {'assignment_id': assignment_id}}},
+        session=_session()
     )
 
     if result:
@@ -210,7 +608,90 @@ def get_assignment(page_id: str, assignment_id: str):
     else:
         raise LookupError(f'Assignment {assignment_id} in page {page_id} not found!')
 
+# Fields of the _id of each kind of document in the stats collection, see recompute_stats
+STATS_ID_FIELDS = {
+    'page_status': ('status', 'group'),
+    'worker_points': ('env', 'points'),
+}
+
+def _page_stats_key(status: Optional[str], group) -> tuple:
+    return ('page_status', status, group)
+
+def _worker_points_stats_key(env: Optional[str], points) -> tuple:
+    return ('worker_points', env, points)
+
+def _stats_id(key: tuple) -> dict:
+    kind, *values = key
+    return {'kind': kind, **dict(zip(STATS_ID_FIELDS[kind], values))}
+
+def _increment_stats(deltas: Counter):
+    """Applies count deltas, keyed by _page_stats_key or _worker_points_stats_key, to the stats collection.
+    """
+    operations = [UpdateOne(
+        {'_id': _stats_id(key)},
+        {'$inc': {'count': delta}},
+        upsert=True
+    ) for key, delta in deltas.items() if delta]
+    if operations:
+        DB.get().stats.bulk_write(operations, ordered=False, session=_session())
+
+def _get_stats(kind: str) -> list[dict]:
+    return [{**doc['_id'], 'count': doc['count']} for doc in DB.get().stats.find({'_id.kind': kind})]
+
+def recompute_stats():
+    """Rebuilds the stats collection from pages and workers.
+
+    The stats collection holds the number of pages per status and group, and the number of workers per env and
+    verification points. The functions in this module which change page statuses or worker points keep it up to date
+    with deltas, so this is only needed to initialize it, and to repair it after the collections were changed elsewhere.
+    """
+    page_counts = DB.get().pages.aggregate([{
+        '$group': {
+            '_id': {'status': '$status', 'group': '$group'},
+            'count': {'$sum': 1}
+        }
+    }])
+    worker_counts = DB.get().workers.aggregate([{
+        '$match': {'verification_points': {'$ne': None}}
+    }, {
+        '$group': {
+            '_id': {'env': '$env', 'points': '$verification_points'},
+            'count': {'$sum': 1}
+        }
+    }])
+    docs = [{
+        '_id': _stats_id(_page_stats_key(res['_id'].get('status'), res['_id'].get('group'))),
+        'count': res['count']
+    } for res in page_counts] + [{
+        '_id': _stats_id(_worker_points_stats_key(res['_id'].get('env'), res['_id']['points'])),
+        'count': res['count']
+    } for res in worker_counts]
+
+    DB.get().stats.delete_many({})
+    if docs:
+        DB.get().stats.insert_many(docs)
+    logging.info(f'Recomputed {len(docs)} stats entries')
+
 def get_status_counts() -> list[dict[str, int]]:
+    """Returns the number of pages per status in the active page groups, sorted by count.
+    Reads the stats collection, and falls back to counting the pages if it is empty.
+    """
+    stats = _get_stats('page_status')
+    if not stats:
+        logging.warning('The stats collection is empty, run recompute-stats to speed up get_status_counts')
+        return _count_statuses()
+
+    groups = Config.get('active_page_groups')
+    counts = Counter()
+    for entry in stats:
+        if not groups or entry['group'] in groups:
+            counts[entry['status']] += entry['count']
+    return sorted(
+        ({'status': status, 'count': count} for status, count in counts.items() if count > 0),
+        key=lambda entry: entry['count']
+    )
+
+def _count_statuses() -> list[dict[str, int]]:
     pipeline = [
         {
             '$group': {
@@ -244,9 +725,11 @@ def get_status_counts() -> list[dict[str, int]]:
     return list(result)
 
 # TODO: Maybe add group filter
-def get_accepted_assignments(exclude_ids: list[str]):
+def get_accepted_assignments(only_unexported: bool = False, batch_size: int = 1000):
     """
-        Returns objects in the shape of {id_: page id, status: page status, assignment: selected assignment}
+        Returns a cursor over objects in the shape of {id_: page id, status: page status, assignment: selected assignment},
+        which fetches batch_size objects at a time.
+        With only_unexported, pages which were marked as exported and haven't changed since are skipped.
 
         The assignment is selected as follows: If the page is in status VERIFIED, the accepted_assignment_id is used.
         Otherwise, if the page status is REVIEWED, the last assignment from the array is selected.
@@ -254,9 +737,6 @@ def get_accepted_assignments(exclude_ids: list[str]):
     pipeline = [
         {
             '$match': {
-                '_id': {
-                    '$nin': exclude_ids
-                }, 
                 'status': {
                     '$in': [PageStatus.REVIEWED.value, PageStatus.VERIFIED.value]
                 },
@@ -311,10 +791,23 @@ def get_accepted_assignments(exclude_ids: list[str]):
     if Config.get('active_page_groups'):
         logging.debug(f'Matching groups {Config.get("active_page_groups")} in get_accepted_assignments')
         pipeline[0]['$match']['group'] = {'$in': Config.get('active_page_groups')}
+    if only_unexported:
+        pipeline[0]['$match']['exported_at'] = {'$exists': False}
 
-    result = DB.get().pages.aggregate(pipeline)
+    result = DB.get().pages.aggregate(pipeline, batchSize=batch_size)
     return result
 
+def mark_pages_exported(page_id_status_list: list[tuple[str, str]], exported_at: datetime):
+    """Sets the exported_at marker on exported pages, unless their status changed since they were read for the export.
+    The marker is removed again whenever a page's status is set.
+    """
+    if page_id_status_list:
+        bulk_results = DB.get().pages.bulk_write([UpdateOne(
+            {'_id': page_id, 'status': status},
+            {'$set': {'exported_at': exported_at}}
+        ) for page_id, status in page_id_status_list], ordered=False)
+        logging.debug(f'Marked {bulk_results.modified_count} page(s) as exported')
+
 def save_qual_requirement(keys: dict):
     keys['env'] = Config.get('env_name')
     keys['_id'] = keys['QualificationTypeId']
@@ -356,146 +849,496 @@ def get_workers_in_id_list(ids: list[str]):
     )
     return result
 
-def update_workers_from_dict(worker_id_ops_dict: dict):
+# Total qualification points of a worker: correctly completed qualification pages plus verification points.
+# Workers store it in qual_points_total, see backfill_qual_points_total. Writes which change it add to the stored
+# total, or to this expression for workers which don't have one yet, see _add_to_qual_points_total.
+QUAL_POINTS_TOTAL_EXPRESSION = {'$add': [
+    {'$size': {'$ifNull': ['$qual_pages_completed', []]}},
+    {'$ifNull': ['$verification_points', 0]}
+]}
+
+def _add_to_qual_points_total(points: int) -> dict:
+    """Returns an aggregation expression for qual_points_total after points were added, to be used in an update pipeline.
+    A plain $inc would set the total of workers without one to just the points.
+    """
+    return {'$add': [{'$ifNull': ['$qual_points_total', QUAL_POINTS_TOTAL_EXPRESSION]}, points]}
+
+def _with_qual_points_total(operations: dict):
+    """Applies $inc of verification_points to qual_points_total as well.
+    Such updates are turned into an update pipeline with one $set stage, so that all expressions see the worker
+    before the update, see _add_to_qual_points_total. Only $set, $inc, $unset and $setOnInsert are supported.
+    """
+    points = operations.get('$inc', {}).get('verification_points')
+    if points is None:
+        return operations
+    unsupported = operations.keys() - {'$set', '$inc', '$unset', '$setOnInsert'}
+    if unsupported:
+        raise ValueError(f'Update operators {unsupported} can\'t be combined with $inc of verification_points')
+    fields: dict[str, Any] = {}
+    for field, value in operations.get('$setOnInsert', {}).items():
+        # A worker created by an upsert only has its _id when the pipeline runs
+        fields[field] = {'$cond': [{'$eq': [{'$size': {'$objectToArray': '$$ROOT'}}, 1]}, {'$literal': value}, f'${field}']}
+    for field, value in operations.get('$set', {}).items():
+        fields[field] = {'$literal': value}
+    for field, value in operations.get('$inc', {}).items():
+        fields[field] = {'$add': [{'$ifNull': [f'${field}', 0]}, value]}
+    fields['qual_points_total'] = _add_to_qual_points_total(points)
+    pipeline: list[dict] = [{'$set': fields}]
+    if operations.get('$unset'):
+        pipeline.append({'$unset': list(operations['$unset'].keys())})
+    return pipeline
+
+def update_workers_from_dict(worker_id_ops_dict: dict) -> WriteResult:
+    """Updates workers by ID, and creates those which don't exist with the current env.
+    Changes of verification_points with $inc are applied to qual_points_total as well.
+    Changes of the points are applied to the stats, see _write_tracked_updates.
+    """
     if worker_id_ops_dict:
-        update_operations = [UpdateOne(
-            {'_id': worker_id},
-            operations,
-            upsert=True
-        ) for worker_id, operations in worker_id_ops_dict.items()]
-        bulk_results = DB.get().workers.bulk_write(update_operations)
+        tracked_updates = []
+        other_operations = []
+        for worker_id, operations in worker_id_ops_dict.items():
+            operations = _with_env_on_insert(operations)
+            # Only workers whose points change can move between histogram entries
+            if not any('verification_points' in fields for fields in operations.values()):
+                other_operations.append(UpdateOne({'_id': worker_id}, operations, upsert=True))
+                continue
+            tracked_updates.append(TrackedUpdate(
+                {'_id': worker_id},
+                _with_qual_points_total(operations),
+                lambda old_worker, operations=operations: _get_new_worker_points(old_worker, operations)
+            ))
+
+        write_result, changes = _write_tracked_updates(
+            'workers', ['env', 'verification_points'], tracked_updates, other_operations, upsert=True
+        )
+        deltas = Counter()
+        for old_worker, new_worker in changes:
+            old_worker = old_worker or {}
+            if old_worker.get('verification_points') is not None:
+                deltas[_worker_points_stats_key(old_worker.get('env'), old_worker['verification_points'])] -= 1
+            if new_worker['verification_points'] is not None:
+                deltas[_worker_points_stats_key(new_worker['env'], new_worker['verification_points'])] += 1
+        _increment_stats(deltas)
+
+        logging.debug(f'Updated: {write_result.modified_count} document(s)')
+        return write_result
+
+def _with_env_on_insert(operations: dict) -> dict:
+    """Adds the current env to workers which are created by the update, see find_workers_in_point_range.
+    """
+    return {**operations, '$setOnInsert': {**operations.get('$setOnInsert', {}), 'env': Config.get('env_name')}}
+
+def _get_new_worker_points(old_worker: Optional[dict], operations: dict) -> dict:
+    """Returns the env and verification_points a worker has after the operations were applied to old_worker,
+    which is None if the worker was created by them.
+    """
+    if old_worker is None:
+        old_worker = operations.get('$setOnInsert', {})
+    new_env = operations.get('$set', {}).get('env', old_worker.get('env'))
+    if 'verification_points' in operations.get('$set', {}):
+        return {'env': new_env, 'verification_points': operations['$set']['verification_points']}
+    if 'verification_points' in operations.get('$inc', {}):
+        return {'env': new_env, 'verification_points': old_worker.get('verification_points', 0) + operations['$inc']['verification_points']}
+    if 'verification_points' in operations.get('$unset', {}):
+        return {'env': new_env, 'verification_points': None}
+    logging.warning(f'Change of verification_points with {operations} is not reflected in the stats, run recompute-stats')
+    return {'env': new_env, 'verification_points': old_worker.get('verification_points')}
+
+# Fields of a worker needed to compute and diff its qualification scores, see qualification_sync
+QUAL_SYNC_FIELDS = {
+    'did_qualification_tasks': 1,
+    # Workers which weren't backfilled yet get the total computed by the DB
+    'qual_points_total': {'$ifNull': ['$qual_points_total', QUAL_POINTS_TOTAL_EXPRESSION]},
+    'synced_quals': 1,
+    'qual_sync_pending': 1,
+}
+
+def get_workers_for_qual_sync(worker_ids: Optional[list[str]] = None, only_pending: bool = False):
+    """Returns a cursor over workers with the fields in QUAL_SYNC_FIELDS.
+
+    Args:
+        worker_ids (Optional[list[str]], optional): Only return these workers. Defaults to all workers.
+        only_pending (bool, optional): Only return workers with changes that weren't pushed to MTurk yet. Defaults to False.
+    """
+    filter: dict[str, Any] = {}
+    if worker_ids is not None:
+        filter['_id'] = {'$in': worker_ids}
+    if only_pending:
+        filter['qual_sync_pending'] = {'$exists': True}
+    return DB.get().workers.find(filter, QUAL_SYNC_FIELDS)
+
+def add_completed_qual_pages(worker_page_pairs: list[tuple[str, str]]):
+    """Adds qualification pages to the qual_pages_completed of existing workers,
+    and increments their qual_points_total only for pages which weren't in there yet.
+    The same write marks the worker as pending, see qualification_sync.mark_pending,
+    so that a sync which runs concurrently can't leave the new total unpushed.
+    """
+    if worker_page_pairs:
+        now = datetime.now()
+        bulk_results = DB.get().workers.bulk_write([UpdateOne(
+            {'_id': worker_id, 'qual_pages_completed': {'$ne': page_id}},
+            [{'$set': {
+                'qual_pages_completed': {'$concatArrays': [{'$ifNull': ['$qual_pages_completed', []]}, {'$literal': [page_id]}]},
+                'qual_points_total': _add_to_qual_points_total(1),
+                'qual_sync_pending': now
+            }}]
+        ) for worker_id, page_id in worker_page_pairs], session=_session())
+        logging.debug(f'Added {bulk_results.modified_count} completed qualification page(s)')
+        return bulk_results
+
+def get_workers_with_wrong_qual_points_total() -> list[str]:
+    """Returns the IDs of workers whose stored qual_points_total differs from their qualification pages and points.
+    """
+    return [worker['_id'] for worker in DB.get().workers.aggregate([
+        {'$project': {'expected': QUAL_POINTS_TOTAL_EXPRESSION, 'stored': {'$ifNull': ['$qual_points_total', None]}}},
+        {'$match': {'$expr': {'$ne': ['$stored', '$expected']}}},
+        {'$project': {'_id': 1}}
+    ])]
+
+def backfill_qual_points_total(batch_size: int = 1000) -> int:
+    """Recomputes qual_points_total of every worker where it is missing or wrong, and returns the number of such workers.
+    Each worker is recomputed atomically on the server, so this is safe while other writes happen.
+    """
+    worker_ids = get_workers_with_wrong_qual_points_total()
+    for i in range(0, len(worker_ids), batch_size):
+        DB.get().workers.update_many(
+            {'_id': {'$in': worker_ids[i:i+batch_size]}},
+            [{'$set': {'qual_points_total': QUAL_POINTS_TOTAL_EXPRESSION}}]
+        )
+    return len(worker_ids)
+
+def backfill_worker_env() -> int:
+    """Sets the current env on all workers without one, and returns their number.
+    Workers without an env used to be returned for every env, but can't be found through an index by equality.
+    """
+    return DB.get().workers.update_many(
+        {'env': {'$exists': False}},
+        {'$set': {'env': Config.get('env_name')}}
+    ).modified_count
+
+def has_workers_without_env() -> bool:
+    """Returns whether some workers have no env yet, see backfill_worker_env.
+    """
+    return DB.get().workers.find_one({'env': None}, {'_id': 1}) is not None
+
+def update_workers_from_tuples(filter_actions_list: list[tuple]):
+    """
+        Updates workers by using the first entry in each tuple as a filter, and the second one as the action.
+        Unlike update_workers_from_dict, workers are not created and the verification point stats are not updated,
+        so the actions must not change verification_points.
+    """
+    if filter_actions_list:
+        bulk_results = DB.get().workers.bulk_write([UpdateOne(filter, action) for filter, action in filter_actions_list])
         logging.debug(f'Updated: {bulk_results.modified_count} document(s)')
         return bulk_results
 
-def get_image_as_bytes(page_id) -> bytes:
+def enqueue_outbox_entries(entries: list[dict]):
+    """Adds entries to the MTurk outbox, see mturk_outbox.
+    The _id of an entry is its idempotency key, and entries whose key is already in the outbox are skipped.
+    """
+    if entries:
+        now = datetime.now()
+        DB.get().mturk_outbox.bulk_write([UpdateOne(
+            {'_id': entry['_id']},
+            {'$setOnInsert': {
+                'status': 'pending',
+                'attempts': 0,
+                'created_at': now,
+                'next_attempt_at': now,
+                **{field: value for field, value in entry.items() if field != '_id'}
+            }},
+            upsert=True
+        ) for entry in entries], session=_session())
+
+def claim_outbox_entries(batch_size: int, lease_sec: float) -> list[dict]:
+    """Claims up to batch_size pending outbox entries which are due, oldest first, for lease_sec seconds.
+    Entries claimed by another dispatcher whose lease hasn't expired are skipped.
+    """
+    now = datetime.now()
+    due_filter = {
+        'status': 'pending',
+        'next_attempt_at': {'$lte': now},
+        '$or': [{'locked_until': {'$exists': False}}, {'locked_until': {'$lt': now}}]
+    }
+    entry_ids = [entry['_id'] for entry in DB.get().mturk_outbox.find(due_filter, {'_id': 1})
+        .sort('next_attempt_at', ASCENDING).limit(batch_size)]
+    if not entry_ids:
+        return []
+    claim = uuid.uuid4().hex
+    DB.get().mturk_outbox.update_many(
+        {**due_filter, '_id': {'$in': entry_ids}},
+        {'$set': {'claim': claim, 'locked_until': now + timedelta(seconds=lease_sec)}}
+    )
+    # Entries claimed by another dispatcher in the meantime keep its claim
+    return list(DB.get().mturk_outbox.find({'_id': {'$in': entry_ids}, 'claim': claim}).sort('created_at', ASCENDING))
+
+def update_outbox_entries(entry_id_ops_dict: dict):
+    if entry_id_ops_dict:
+        bulk_results = DB.get().mturk_outbox.bulk_write([
+            UpdateOne({'_id': entry_id}, operations) for entry_id, operations in entry_id_ops_dict.items()
+        ])
+        logging.debug(f'Updated: {bulk_results.modified_count} outbox entries')
+        return bulk_results
+
+def reset_failed_outbox_entries() -> int:
+    """Makes failed outbox entries pending again and returns their number.
+    """
+    return DB.get().mturk_outbox.update_many(
+        {'status': 'failed'},
+        {'$set': {'status': 'pending', 'attempts': 0, 'next_attempt_at': datetime.now()}}
+    ).modified_count
+
+def _notification_id(campaign_id: str, worker_id: str) -> str:
+    return f'{campaign_id}:{worker_id}'
+
+def get_notified_worker_ids(campaign_id: str, worker_ids: list[str]) -> set[str]:
+    """Returns which of the workers were already notified in the campaign, see worker_notifications.
+    """
+    return {notification['worker_id'] for notification in DB.get().worker_notifications.find(
+        {'_id': {'$in': [_notification_id(campaign_id, worker_id) for worker_id in worker_ids]}, 'notified': True},
+        {'worker_id': 1}
+    )}
+
+def save_notification_results(campaign_id: str, worker_ids: list[str], failure_statuses: list[dict]):
+    """Records the outcome of notifying workers in a campaign, one document per campaign and worker.
+
+    Args:
+        campaign_id (str): ID of the campaign.
+        worker_ids (list[str]): All workers the notification was sent to.
+        failure_statuses (list[dict]): NotifyWorkersFailureStatuses of the workers who couldn't be notified.
+    """
+    failures = {status['WorkerId']: status for status in failure_statuses}
+    now = datetime.now()
+    update_operations = []
+    for worker_id in worker_ids:
+        update: dict[str, Any] = {
+            '$set': {'campaign_id': campaign_id, 'worker_id': worker_id, 'notified': worker_id not in failures, 'time': now},
+            '$inc': {'attempts': 1}
+        }
+        if worker_id in failures:
+            update['$set']['failure_code'] = failures[worker_id].get('NotifyWorkersFailureCode')
+            update['$set']['failure_message'] = failures[worker_id].get('NotifyWorkersFailureMessage')
+        else:
+            update['$unset'] = {'failure_code': '', 'failure_message': ''}
+        update_operations.append(UpdateOne({'_id': _notification_id(campaign_id, worker_id)}, update, upsert=True))
+    if update_operations:
+        DB.get().worker_notifications.bulk_write(update_operations, ordered=False)
+
+def get_image_as_bytes(page_id, use_cache: bool = True) -> bytes:
     """Takes a page id and returns the bytes of the rasterized image.
     If the file is not available locally, it fetches it from image_url_base,
     and saves the response before returning the data.
+    Recently used images are kept in IMAGE_CACHE, whose size is set by image_cache_max_bytes.
 
     Args:
         page_id (_type_): ID of the rasterized page
+        use_cache (bool, optional): Set to False for pages which are only read once. Defaults to True.
 
     Returns:
         bytes: Image as bytes
     """
+    if not use_cache:
+        data = IMAGE_CACHE.get(page_id)
+        return data if data is not None else _read_image(page_id)
+    return IMAGE_CACHE.get_or_load(page_id, lambda: _read_image(page_id))
 
-    img_path = Config.get('image_folder') + page_id + Config.get('image_extension')
+def _read_image(page_id) -> bytes:
+    img_path = get_image_path(page_id)
     if not os.path.isfile(img_path):
-        data: bytes = urllib.request.urlopen(Config.get('image_url_base') + page_id + Config.get('image_extension')).read()
-        open(img_path, 'wb').write(data)
+        data = download_image(page_id)
         logging.warning(f'Image not found on path {img_path}. Instead, it was downloaded from image_url_base. Consider downloading the rasterized pages locally for better performance.')
     else:
-        data = open(img_path, 'rb').read()
+        with open(img_path, 'rb') as file:
+            data = file.read()
     return data
 
+def get_image_path(page_id) -> str:
+    return Config.get('image_folder') + page_id + Config.get('image_extension')
+
+def download_image(page_id) -> bytes:
+    """Downloads a rasterized page from image_url_base into image_folder and returns its bytes.
+
+    Concurrent calls for the same page share one download. The file is written to a temporary file first
+    and then renamed, so readers never see a half-written image.
+    HTTP connections are reused across calls.
+
+    Args:
+        page_id (_type_): ID of the rasterized page
+
+    Raises:
+        LookupError: If the image could not be downloaded.
+
+    Returns:
+        bytes: Image as bytes
+    """
+    with DOWNLOAD_LOCK:
+        download = DOWNLOADS_IN_FLIGHT.get(page_id)
+        is_owner = download is None
+        if is_owner:
+            download = Future()
+            DOWNLOADS_IN_FLIGHT[page_id] = download
+    if not is_owner:
+        logging.debug(f'Waiting for running download of page {page_id}')
+        return download.result()
+
+    try:
+        img_path = get_image_path(page_id)
+        # The previous download of this page might have finished in the meantime
+        if os.path.isfile(img_path):
+            with open(img_path, 'rb') as file:
+                data = file.read()
+        else:
+            url = Config.get('image_url_base') + page_id + Config.get('image_extension')
+            response = HTTP_POOL.request('GET', url)
+            if response.status != 200:
+                raise LookupError(f'Could not download image {url}, status was {response.status}')
+            data = response.data
+            tmp_fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(img_path) or None, suffix='.tmp')
+            try:
+                with os.fdopen(tmp_fd, 'wb') as file:
+                    file.write(data)
+                os.chmod(tmp_path, NEW_FILE_MODE)
+                os.replace(tmp_path, img_path)
+            except BaseException:
+                os.remove(tmp_path)
+                raise
+            logging.debug(f'Downloaded image {url} to {img_path}')
+        download.set_result(data)
+        return data
+    except BaseException as e:
+        download.set_exception(e)
+        raise
+    finally:
+        with DOWNLOAD_LOCK:
+            del DOWNLOADS_IN_FLIGHT[page_id]
+
 class WorkerPointsBucket(NamedTuple):
-    begin: float
-    end: float
+    begin: int
+    end: int
     count: int
 
-def get_worker_verification_points_distribution(nr_buckets= 10) -> list[WorkerPointsBucket]:
-    min_max_res = DB.get().workers.aggregate([
-        {
-            '$match': {
-                '$or': [
-                    {
-                        'env': None
-                    }, {
-                        'env': Config.get('env_name')
-                    }
-                ]
-            }
-        },
-        {
-            '$group': {
-                'max': {
-                    '$max': '$verification_points'
-                }, 
-                'min': {
-                    '$min': '$verification_points'
-                }, 
-                '_id': None
-            }
-        }
-    ]).next()
-    max_points = min_max_res['max']
-    min_points = min_max_res['min']
-    bucket_boundaries = np.linspace(min_points, max_points+1, nr_buckets).tolist()
+def get_worker_points_histogram(nr_buckets: int = 10) -> list[WorkerPointsBucket]:
+    """Returns a histogram of the verification points of the workers in the current env,
+    computed in a single aggregation over the stats collection, or over the workers if the stats are empty.
 
-    bucket_response =  DB.get().workers.aggregate([
-        {
+    Buckets have the same integer width, and the first one starts at the lowest number of points.
+    If the points span fewer than nr_buckets values, fewer buckets are returned.
+    Workers without verification points are not counted.
+
+    Args:
+        nr_buckets (int, optional): Maximal number of buckets. Defaults to 10.
+
+    Returns:
+        list[WorkerPointsBucket]: Buckets in ascending order, including empty ones.
+    """
+    if DB.get().stats.find_one({'_id.kind': 'worker_points'}, {'_id': 1}):
+        collection = DB.get().stats
+        count_by_points = [{
             '$match': {
-                '$or': [
-                    {
-                        'env': None
-                    }, {
-                        'env': Config.get('env_name')
-                    }
-                ]
-            }
-        },
-        {
-            '$bucket': {
-                'groupBy': '$verification_points', 
-                'boundaries': bucket_boundaries, 
-                'output': {
-                    'count': {
-                        '$sum': 1
-                    }
-                }
-            }
-        }
-    ])
-    bucket_begin_size_map = {res['_id']:res['count'] for res in bucket_response}
-    buckets: list[WorkerPointsBucket] = []
-    for i in range(len(bucket_boundaries) - 1):
-        begin = bucket_boundaries[i]
-        end = bucket_boundaries[i+1]
-        count = bucket_begin_size_map[begin] if (begin in bucket_begin_size_map) else 0
-        buckets.append(WorkerPointsBucket(begin, end, count))
-    return buckets
-
-def get_workers_in_verification_point_range(
-    min: int,
-    max: int,
-    filter_env: bool = True
-) -> list[dict]:
-
-    and_part = []
-    or_part = [
-        {
-            'env': {
-                '$exists': 0
+                '_id.kind': 'worker_points',
+                '_id.env': Config.get('env_name')
             }
         }, {
-            'env': Config.get('env_name')
-        }
-    ]
-
-    if min is not None:
-        and_part.append({
-            'verification_points': {
-                '$gte': min
+            '$group': {'_id': '$_id.points', 'count': {'$sum': '$count'}}
+        }]
+    else:
+        collection = DB.get().workers
+        count_by_points = [{
+            '$match': {
+                'env': Config.get('env_name'),
+                'verification_points': {'$ne': None}
             }
-        })
+        }, {
+            '$group': {'_id': '$verification_points', 'count': {'$sum': 1}}
+        }]
 
-    if max is not None:
-        and_part.append({
-            'verification_points': {
-                '$lte': max
-            }
-        })
-    
-    aggregation_pipeline = [
-        {
-            '$match': { }
+    # From here on there is one document per distinct number of points, so the $facet output stays small
+    result = list(collection.aggregate(count_by_points + [{
+        '$match': {'count': {'$gt': 0}}
+    }, {
+        '$facet': {
+            'range': [{
+                '$group': {'_id': None, 'min': {'$min': '$_id'}, 'max': {'$max': '$_id'}}
+            }, {
+                '$project': {'begin': {'$floor': '$min'}, 'end': {'$add': [{'$floor': '$max'}, 1]}}
+            }, {
+                '$set': {'width': {'$max': [1, {'$ceil': {'$divide': [{'$subtract': ['$end', '$begin']}, nr_buckets]}}]}}
+            }],
+            'values': [{'$project': {'points': '$_id', 'count': 1}}]
         }
-    ]
+    }, {
+        '$unwind': '$range'
+    }, {
+        '$unwind': '$values'
+    }, {
+        '$group': {
+            '_id': {'$floor': {'$divide': [{'$subtract': ['$values.points', '$range.begin']}, '$range.width']}},
+            'count': {'$sum': '$values.count'},
+            'range': {'$first': '$range'}
+        }
+    }]))
+    if not result:
+        return []
 
-    if and_part:
-        aggregation_pipeline[0]['$match']['$and'] = and_part
+    begin = int(result[0]['range']['begin'])
+    end = int(result[0]['range']['end'])
+    width = int(result[0]['range']['width'])
+    counts = {int(res['_id']): res['count'] for res in result}
+    return [
+        WorkerPointsBucket(bucket_begin, bucket_begin + width, counts.get(i, 0))
+        for i, bucket_begin in enumerate(range(begin, end, width))
+    ]
 
+def _worker_point_range_filter(min_points: Optional[int], max_points: Optional[int], filter_env: bool, points_field: str) -> dict:
+    filter: dict[str, Any] = {}
     if filter_env:
-        aggregation_pipeline[0]['$match']['$or'] = or_part
+        # Equality keeps the query covered by the index, workers without an env are given one by backfill_worker_env
+        filter['env'] = Config.get('env_name')
+    point_range = {}
+    if min_points is not None:
+        point_range['$gte'] = min_points
+    if max_points is not None:
+        point_range['$lte'] = max_points
+    if point_range:
+        filter[points_field] = point_range
+    return filter
 
-    return list(DB.get().workers.aggregate(aggregation_pipeline))
\ No newline at end of file
+def find_workers_in_point_range(
+    min_points: Optional[int] = None,
+    max_points: Optional[int] = None,
+    filter_env: bool = True,
+    fields: Iterable[str] = ('_id',),
+    batch_size: int = 1000,
+    points_field: str = 'verification_points'
+) -> Cursor:
+    """Returns a cursor over the workers whose verification points (or total qualification points) lie in the given range,
+    fetched in batches and with only the given fields.
+    The query is served by the env_verification_points_id (or env_qual_points_total_id) index, which also holds _id,
+    so that the default ID-only query doesn't need to read the worker documents.
+
+    Args:
+        min_points (Optional[int], optional): Inclusive lower bound. Defaults to no bound.
+        max_points (Optional[int], optional): Inclusive upper bound. Defaults to no bound.
+        filter_env (bool, optional): Only return workers of the current env. Defaults to True.
+        fields (Iterable[str], optional): Fields of the returned documents. Defaults to ('_id',).
+        batch_size (int, optional): Number of workers fetched per round trip. Defaults to 1000.
+        points_field (str, optional): verification_points or qual_points_total. Defaults to verification_points.
+    """
+    projection = {field: 1 for field in fields}
+    if '_id' not in projection:
+        projection['_id'] = 0
+    return DB.get().workers.find(
+        _worker_point_range_filter(min_points, max_points, filter_env, points_field),
+        projection,
+        batch_size=batch_size
+    )
+
+def count_workers_in_point_range(
+    min_points: Optional[int] = None,
+    max_points: Optional[int] = None,
+    filter_env: bool = True,
+    points_field: str = 'verification_points'
+) -> int:
+    """Counts the workers find_workers_in_point_range would return, with a count over the same index.
+    """
+    return DB.get().workers.count_documents(_worker_point_range_filter(min_points, max_points, filter_env, points_field))
@@ -0,0 +1,99 @@
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import os
+import shutil
+import stat
+import tempfile
+import threading
+import time
+import unittest
+from config import Config
+
+Config.parse_env_file(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), '.env.example'))
+import repository
+
+PAGE_DATA = b'\x89PNG' + bytes(range(256)) * 4096
+
+class ImageHandler(BaseHTTPRequestHandler):
+    """Serves PAGE_DATA for every page, slowly, and counts the requests per path.
+    """
+    requests: dict[str, int] = {}
+    lock = threading.Lock()
+
+    def do_GET(self):
+        with self.lock:
+            self.requests[self.path] = self.requests.get(self.path, 0) + 1
+        if self.path.startswith('/missing'):
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(PAGE_DATA)))
+        self.end_headers()
+        # Send the image in parts, so that concurrent calls overlap with a running download
+        for i in range(0, len(PAGE_DATA), len(PAGE_DATA) // 4):
+            self.wfile.write(PAGE_DATA[i:i + len(PAGE_DATA) // 4])
+            self.wfile.flush()
+            time.sleep(0.05)
+
+    def log_message(self, format, *args):
+        pass
+
+class DownloadImageTest(unittest.TestCase):
+
+    def setUp(self):
+        ImageHandler.requests = {}
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), ImageHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.image_folder = tempfile.mkdtemp()
+        Config.set('image_folder', self.image_folder + os.sep)
+        Config.set('image_url_base', f'http://127.0.0.1:{self.server.server_port}/')
+        Config.set('image_extension', '.png')
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.image_folder)
+
+    def test_concurrent_calls_share_one_download(self):
+        page_ids = ['page-1', 'page-2']
+        with ThreadPoolExecutor(max_workers=16) as executor:
+            results = list(executor.map(repository.download_image, page_ids * 8))
+
+        self.assertTrue(all(result == PAGE_DATA for result in results))
+        self.assertEqual(ImageHandler.requests, {'/page-1.png': 1, '/page-2.png': 1})
+        self.assertEqual(repository.DOWNLOADS_IN_FLIGHT, {})
+
+    def test_no_partial_files(self):
+        written_sizes = set()
+        stop = threading.Event()
+
+        def watch():
+            # Every time the final file exists, it must be complete
+            path = repository.get_image_path('page-1')
+            while not stop.is_set():
+                if os.path.exists(path):
+                    written_sizes.add(os.path.getsize(path))
+
+        watcher = threading.Thread(target=watch)
+        watcher.start()
+        try:
+            repository.download_image('page-1')
+        finally:
+            stop.set()
+            watcher.join()
+
+        # The watcher may not have run after the rename, but it must never have seen a partial file
+        self.assertLessEqual(written_sizes, {len(PAGE_DATA)})
+        self.assertEqual(os.path.getsize(repository.get_image_path('page-1')), len(PAGE_DATA))
+        self.assertEqual(os.listdir(self.image_folder), ['page-1.png'])
+        mode = stat.S_IMODE(os.stat(repository.get_image_path('page-1')).st_mode)
+        self.assertEqual(mode, repository.NEW_FILE_MODE)
+
+    def test_failed_download_leaves_no_file(self):
+        with self.assertRaises(LookupError):
+            repository.download_image('missing')
+        self.assertEqual(os.listdir(self.image_folder), [])
+        self.assertEqual(repository.DOWNLOADS_IN_FLIGHT, {})
+
+if __name__ == '__main__':
+    unittest.main()
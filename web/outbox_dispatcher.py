@@ -0,0 +1,45 @@
+import logging
+import threading
+import mturk_outbox
+
+class OutboxDispatcher:
+    """Drains the MTurk outbox on a background thread, so that review actions don't wait for MTurk.
+
+    The thread is started on first use. It dispatches whenever it is woken up after new entries were queued,
+    and every interval_sec seconds, so that retries and entries left over from before a restart are sent as well.
+    """
+
+    def __init__(self, interval_sec: float = 30):
+        """
+        Args:
+            interval_sec (float, optional): Time between dispatches without a wake-up. Defaults to 30.
+        """
+        self.interval_sec = interval_sec
+        self.__wake_up = threading.Event()
+        self.__thread = None
+        self.__lock = threading.Lock()
+
+    def start(self):
+        """Starts the background thread if it isn't running yet.
+        """
+        with self.__lock:
+            if self.__thread is None:
+                self.__thread = threading.Thread(target=self.__run, name='outbox-dispatcher', daemon=True)
+                self.__thread.start()
+
+    def wake(self):
+        """Dispatches as soon as possible, e.g. after entries were queued.
+        """
+        self.start()
+        self.__wake_up.set()
+
+    def __run(self):
+        while True:
+            try:
+                mturk_outbox.dispatch()
+            except Exception:
+                logging.exception('Could not dispatch the MTurk outbox')
+            self.__wake_up.wait(self.interval_sec)
+            self.__wake_up.clear()
+
+OUTBOX_DISPATCHER = OutboxDispatcher()
@@ -0,0 +1,116 @@
+from collections import deque
+import logging
+import threading
+import time
+from typing import Optional
+from config import Config
+from enums.page_status import PageStatus
+import repository
+
+class ReviewQueue:
+    """Serves pages to review from shuffled batches of page IDs, which are prefetched per page status and page groups.
+
+    A page that is handed out is leased to its reviewer for lease_sec seconds, during which it is not handed out again.
+    Pages released after a review are dropped from every batch fetched before the release,
+    and entries older than max_age_sec are dropped as well, since their page status could have changed elsewhere.
+    """
+
+    def __init__(self, batch_size: int = 50, low_watermark: int = 10, lease_sec: float = 600, max_age_sec: float = 300):
+        """
+        Args:
+            batch_size (int, optional): Number of page IDs fetched at once. Defaults to 50.
+            low_watermark (int, optional): A refill is started in the background when fewer entries are queued. Defaults to 10.
+            lease_sec (float, optional): How long a handed out page is reserved for its reviewer. Defaults to 600.
+            max_age_sec (float, optional): Queued entries older than this are dropped. Defaults to 300.
+        """
+        self.batch_size = batch_size
+        self.low_watermark = low_watermark
+        self.lease_sec = lease_sec
+        self.max_age_sec = max_age_sec
+        # (page status, page groups) -> deque of (page ID, time fetched)
+        self.__queues: dict[tuple, deque[tuple[str, float]]] = {}
+        self.__refilling: set[tuple] = set()
+        # Page ID -> lease expiry time
+        self.__leases: dict[str, float] = {}
+        # Page ID -> time of the last release
+        self.__released: dict[str, float] = {}
+        self.__last_cleanup = time.time()
+        self.__lock = threading.Lock()
+
+    def next_page_id(self, status: PageStatus) -> str:
+        """Returns the ID of a random page in the given status and leases it.
+
+        Raises:
+            LookupError: If there are no pages left in this status which aren't leased.
+        """
+        groups = Config.get('active_page_groups')
+        key = (status, tuple(groups) if groups else None)
+        page_id, nr_queued = self.__pop(key)
+        if page_id is None:
+            self.__refill(key)
+            page_id, nr_queued = self.__pop(key)
+        if nr_queued < self.low_watermark:
+            with self.__lock:
+                start_refill = key not in self.__refilling
+                self.__refilling.add(key)
+            if start_refill:
+                threading.Thread(target=self.__refill, args=(key, True), daemon=True).start()
+        if page_id is None:
+            raise LookupError(f'There are no more unleased pages in the status {status.value}!')
+        return page_id
+
+    def release(self, page_id: str):
+        """Ends the lease of a page after it was reviewed, and drops it from all batches fetched before this call.
+        """
+        with self.__lock:
+            self.__leases.pop(page_id, None)
+            self.__released[page_id] = time.time()
+
+    def __pop(self, key: tuple) -> tuple[Optional[str], int]:
+        """Pops the first valid entry of a queue, and returns its page ID (or None) together with the remaining queue length.
+        """
+        now = time.time()
+        with self.__lock:
+            queue = self.__queues.setdefault(key, deque())
+            page_id = None
+            while queue:
+                candidate, fetched_at = queue.popleft()
+                if now - fetched_at > self.max_age_sec:
+                    continue
+                if self.__released.get(candidate, 0) >= fetched_at:
+                    continue
+                if self.__leases.get(candidate, 0) > now:
+                    continue
+                page_id = candidate
+                self.__leases[page_id] = now + self.lease_sec
+                break
+
+            # Every now and then, forget expired leases and releases which can't affect any queued entry anymore
+            if now - self.__last_cleanup > self.max_age_sec:
+                self.__leases = {id: expiry for id, expiry in self.__leases.items() if expiry > now}
+                self.__released = {id: released_at for id, released_at in self.__released.items() if now - released_at <= self.max_age_sec}
+                self.__last_cleanup = now
+            return page_id, len(queue)
+
+    def __refill(self, key: tuple, in_background: bool = False):
+        status, _ = key
+        try:
+            fetched_at = time.time()
+            pages = repository.get_random_pages_by_status([status], self.batch_size, True)
+            with self.__lock:
+                queue = self.__queues.setdefault(key, deque())
+                queued_ids = {page_id for page_id, _ in queue}
+                queue.extend((page['_id'], fetched_at) for page in pages if page['_id'] not in queued_ids)
+            logging.debug(f'Review queue for {key} refilled with {len(pages)} page(s)')
+        except LookupError as e:
+            logging.debug(f'Review queue for {key} could not be refilled: {e}')
+        except Exception:
+            if not in_background:
+                raise
+            logging.exception(f'Review queue for {key} could not be refilled')
+        finally:
+            if in_background:
+                with self.__lock:
+                    self.__refilling.discard(key)
+
+REVIEW_QUEUE = ReviewQueue()
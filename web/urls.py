@@ -16,10 +16,11 @@ Including another URLconf
 from django.contrib import admin
 from django.urls import path
 
-from .views import Assignment, review, review_page, index, compare_predictions
+from .views import Assignment, review, review_page, index, compare_predictions, worker_points_histogram
 
 urlpatterns = [
     path('', index, name='index'),
+    path('stats/worker-points', worker_points_histogram, name='worker_points_histogram'),
     path('admin/', admin.site.urls),
     path('assignment/<str:page_id>/<str:assignment_id>', Assignment.as_view(), name='assignment'),
     path('review/', review, name='review'),
@@ -2,15 +2,16 @@ from datetime import datetime
 from distutils.log import debug
 import json
 import logging
-from django.http import JsonResponse, Http404, QueryDict
+from django.http import JsonResponse, Http404, HttpResponseBadRequest, QueryDict
 from django.http.response import HttpResponseRedirect
 from django.shortcuts import render
 from django.urls import reverse
 from sci_annot_eval.common.bounding_box import RelativeBoundingBox
 import config
 from enums.assignment_status import AssignmentStatus
-from enums.qualification_types import QualificationType
-import mturk_client
+import mturk_outbox
+import page_images
+import qualification_sync
 import repository
 from config import Config
 from enums.page_status import PageStatus
@@ -24,10 +25,11 @@ import random
 from question_form_answers_parser import parse_typed_dict, sci_annot_parsers_dict
 from sci_annot_eval.parsers import sci_annot_parser
 from sci_annot_eval.exporters import sci_annot_exporter
-from sci_annot_eval.helpers import helpers
 from typing import Any, cast
 from sci_annot_eval.common.bounding_box import AbsoluteBoundingBox
 import os
+from .outbox_dispatcher import OUTBOX_DISPATCHER
+from .review_queue import REVIEW_QUEUE
 answer_parser = sci_annot_parser.SciAnnotParser()
 answer_exporter = sci_annot_exporter.SciAnnotExporter()
 
@@ -39,9 +41,9 @@ def id_generator(size=6, chars=string.ascii_uppercase + string.digits):
     return ''.join(random.choice(chars) for _ in range(size))
 
 def index(request):
+    # Sends MTurk actions queued before a restart
+    OUTBOX_DISPATCHER.start()
     status_counts = repository.get_status_counts()
-    worker_points_buckets = repository.get_worker_verification_points_distribution()
-    nr_workers = sum([bucket.count for bucket in worker_points_buckets])
     total_page_count = 0
     for status_count in status_counts:
         total_page_count += status_count['count']
@@ -51,14 +53,28 @@ def index(request):
     context = {
         'status_counts': status_counts,
         'total_page_count': total_page_count,
-        'worker_points_buckets': worker_points_buckets,
-        'nr_workers': nr_workers,
         'environment': Config.get('env_name'),
         'active_page_groups': Config.get('active_page_groups')
     }
     logging.debug(f'context: {context}')
     return render(request, 'web/index.html', context)
 
+def worker_points_histogram(request):
+    """Returns the worker verification points histogram as JSON.
+    The number of buckets can be set with the "buckets" query parameter, and defaults to worker_points_buckets.
+    """
+    try:
+        nr_buckets = int(request.GET.get('buckets', Config.get_or_default('worker_points_buckets', 10)))
+    except ValueError:
+        return HttpResponseBadRequest('buckets must be an integer')
+    if nr_buckets < 1:
+        return HttpResponseBadRequest('buckets must be positive')
+
+    buckets = repository.get_worker_points_histogram(nr_buckets)
+    return JsonResponse({
+        'buckets': [bucket._asdict() for bucket in buckets],
+        'nr_workers': sum(bucket.count for bucket in buckets)
+    })
 
 def reject_unreviewed_assignments(page_id: str):
     """Rejects all assignments of a page that don't have a "status" field.
@@ -68,36 +84,28 @@ def reject_unreviewed_assignments(page_id: str):
         page_id (str)
     """
     repository.assert_qual_types_exist()
-    qual_points_id = repository.get_qual_type_id(QualificationType.QUAL_POINTS)
-    # This is just to satisfy the type system.
-    # The assertion that these are not None is done at the beginning of the block.
-    if qual_points_id is not None:
-        rejection_candidate_assignments = repository.get_page_by_id(page_id)['assignments']
-        rejectable_assignments = [
-            assig for assig in rejection_candidate_assignments 
-            if 'status' not in assig
-        ]
-        logging.debug(f'rejecting unreviewed assignments: {[assig["assignment_id"] for assig in rejectable_assignments]}')
-        assignment_status_update_dict = {
-            assig['assignment_id']:AssignmentStatus.MANUALLY_REJECTED 
-            for assig in rejectable_assignments
-        }
-        for assignment in rejectable_assignments:
-            if datetime.now() < assignment['auto_approval_time']:
-                mturk_client.reject_assignment(assignment['assignment_id'])
-        workers_to_punish = [assignment['worker_id'] for assignment in rejectable_assignments]
-        worker_action_dict = {}
-        for worker_id in workers_to_punish:
-            worker_action_dict[worker_id] = \
-                {'$inc': {'verification_points': -int(Config.get('rejected_assignment_penalty'))}}
-        repository.update_workers_from_dict(worker_action_dict)
-        curr_worker_states = repository.get_workers_in_id_list(list(worker_action_dict.keys()))
-        for worker in curr_worker_states:
-            total_qual_points = worker['verification_points'] + \
-                (len(worker['qual_pages_completed']) if 'qual_pages_completed' in worker.keys()\
-                else 0)
-            mturk_client.assign_qualification_to_worker(qual_points_id, worker['_id'], total_qual_points)
-        repository.update_assignment_statuses_from_dict(page_id, assignment_status_update_dict)
+    rejection_candidate_assignments = repository.get_page_by_id(page_id)['assignments']
+    rejectable_assignments = [
+        assig for assig in rejection_candidate_assignments 
+        if 'status' not in assig
+    ]
+    logging.debug(f'rejecting unreviewed assignments: {[assig["assignment_id"] for assig in rejectable_assignments]}')
+    assignment_status_update_dict = {
+        assig['assignment_id']:AssignmentStatus.MANUALLY_REJECTED 
+        for assig in rejectable_assignments
+    }
+    mturk_outbox.enqueue_rejections([
+        assignment['assignment_id'] for assignment in rejectable_assignments
+        if datetime.now() < assignment['auto_approval_time']
+    ])
+    workers_to_punish = [assignment['worker_id'] for assignment in rejectable_assignments]
+    worker_action_dict = {}
+    for worker_id in workers_to_punish:
+        worker_action_dict[worker_id] = qualification_sync.mark_pending(
+            {'$inc': {'verification_points': -int(Config.get('rejected_assignment_penalty'))}}
+        )
+    repository.update_workers_from_dict(worker_action_dict)
+    repository.update_assignment_statuses_from_dict(page_id, assignment_status_update_dict)
 
 @method_decorator(csrf_exempt, name='dispatch')
 class Assignment(View):
@@ -157,9 +165,9 @@ class Assignment(View):
             if(crop_whitespace):
                 orig_answer = assignment['answer']
                 orig_bboxes = answer_parser.parse_dict(orig_answer, False)
-                img_bytes = repository.get_image_as_bytes(page_id)
+                img = page_images.get_page_image(page_id)
                 # TODO: Remove the need for casting
-                cropped_bboxes = helpers.crop_all_to_content(img_bytes, cast(list[AbsoluteBoundingBox],orig_bboxes))
+                cropped_bboxes = page_images.crop_all_to_content(img, cast(list[AbsoluteBoundingBox],orig_bboxes))
                 exported_annots = answer_exporter.export_to_dict(cropped_bboxes, int(orig_answer['canvasWidth']), int(orig_answer['canvasHeight']))
                 orig_answer['annotations'] = exported_annots['annotations']
             logging.debug(f'Returning assignment: {assignment}')
@@ -169,10 +177,26 @@ class Assignment(View):
 
     @csrf_exempt
     def post(self, request, page_id: str, assignment_id: str):
-        if assignment_id != 'REJECT':
-            post_data: dict = request.POST.dict()
-            logging.debug(f'POST data: ${post_data}')
+        post_data: dict = request.POST.dict()
+        logging.debug(f'POST data: ${post_data}')
+        # The page, the assignments, the workers and the MTurk outbox are updated together,
+        # and the outbox is sent to MTurk in the background afterwards
+        update_resp = repository.run_in_transaction(lambda: self.save_review(page_id, assignment_id, post_data))
+        OUTBOX_DISPATCHER.wake()
+
+        REVIEW_QUEUE.release(page_id)
+        query_dict = request.GET.copy()
+        if(update_resp and update_resp.matched_count):
+            reversed_url = reverse('review')
+            full_redirect_url = reversed_url + '?' + query_dict.urlencode()
+            return HttpResponseRedirect(full_redirect_url)
+        else:
+            raise Http404('Page/assignment combination not found!')
 
+    def save_review(self, page_id: str, assignment_id: str, post_data: dict):
+        """Saves the verdict of a reviewer on a page, and queues the resulting MTurk actions.
+        """
+        if assignment_id != 'REJECT':
             set_data = {
                 'status': PageStatus.VERIFIED.value,
             }
@@ -204,21 +228,10 @@ class Assignment(View):
                     # Reverse penalty
                     if 'status' in assignment and assignment['status'] == AssignmentStatus.MANUALLY_REJECTED.value:
                         bonus_points += int(Config.get('rejected_assignment_penalty'))
-                    worker_action_dict = {worker_id: {'$inc': {'verification_points': bonus_points }}}
+                    worker_action_dict = {worker_id: qualification_sync.mark_pending({'$inc': {'verification_points': bonus_points }})}
                     repository.update_workers_from_dict(worker_action_dict)
-                    worker = repository.get_workers_in_id_list([worker_id]).next()
-                    total_qual_points = worker['verification_points'] + \
-                        (len(worker['qual_pages_completed']) if 'qual_pages_completed' in worker.keys()\
-                        else 0)
-                    
-                    qual_points_id = repository.get_qual_type_id(QualificationType.QUAL_POINTS)
-                    # This is just to satisfy the type system.
-                    # The assertion that these are not None is done at the beginning of the block.
-                    if qual_points_id is not None:
-                        # TODO: This needs a transaction
-                        mturk_client.assign_qualification_to_worker(qual_points_id, worker_id, total_qual_points) 
                     if datetime.now() < assignment['auto_approval_time']:
-                        mturk_client.approve_assignment(assignment_id)
+                        mturk_outbox.enqueue_approval(assignment_id)
                     repository.update_assignment_statuses_from_dict(page_id, {assignment_id: AssignmentStatus.MANUALLY_ACCEPTED})
 
                     if "strict" in post_data.keys():
@@ -242,24 +255,16 @@ class Assignment(View):
                     }
                 }
             })
-        
-        query_dict = request.GET.copy()
-        if(update_resp and update_resp.matched_count):
-            reversed_url = reverse('review')
-            full_redirect_url = reversed_url + '?' + query_dict.urlencode()
-            return HttpResponseRedirect(full_redirect_url)
-        else:
-            raise Http404('Page/assignment combination not found!')
+        return update_resp
 
 def review(request):
     # Get page status from query string if exists, otherwise use deferred
     page_status = request.GET.get('page_status', PageStatus.DEFERRED.name)
     
     try:
-        # TODO: This can be cached to reduce DB round-trips
-        random_page = repository.get_random_pages_by_status([PageStatus[page_status.upper()]], 1)[0]
+        random_page_id = REVIEW_QUEUE.next_page_id(PageStatus[page_status.upper()])
         # Django has terrible support for query params
-        reversed_url = reverse('review_page', kwargs={'page_id': random_page['_id']})
+        reversed_url = reverse('review_page', kwargs={'page_id': random_page_id})
         full_redirect_url = reversed_url + '?' + request.GET.urlencode()
         return HttpResponseRedirect(full_redirect_url)
     except LookupError as e:
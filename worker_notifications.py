@@ -0,0 +1,87 @@
+from datetime import datetime
+import logging
+from typing import Iterable, NamedTuple, Optional
+import uuid
+from config import Config
+import mturk_client
+from parallel import RateLimiter, chunked, run_bounded
+import repository
+
+class NotificationResult(NamedTuple):
+    campaign_id: str
+    nr_notified: int
+    # Workers who were already notified in an earlier run of the campaign
+    nr_skipped: int
+    nr_failed: int
+
+def new_campaign_id() -> str:
+    """Returns a new, unique campaign ID, which starts with the current time so that campaigns sort by age.
+    """
+    return f'{datetime.now():%Y%m%d-%H%M%S}-{uuid.uuid4().hex[:8]}'
+
+def notify_workers(
+    subject: str,
+    message_text: str,
+    worker_ids: Iterable[str],
+    campaign_id: Optional[str] = None,
+    concurrency: int = 4,
+    calls_per_sec: Optional[float] = None
+) -> NotificationResult:
+    """Sends an email to any number of workers, split into calls of up to mturk_client.NOTIFY_WORKERS_MAX_RECIPIENTS workers.
+
+    Every worker's outcome is stored in the worker_notifications collection under the campaign ID, together with
+    the failure code and message MTurk returned in NotifyWorkersFailureStatuses. Workers who were notified
+    in an earlier run of the same campaign are skipped, so an interrupted campaign can be resumed by passing its ID,
+    which is logged at the start. Without an ID, a new campaign is started, so a message can be sent again.
+
+    Args:
+        subject (str): Subject of the email.
+        message_text (str): Body of the email.
+        worker_ids (Iterable[str]): Workers to notify. Duplicates are only notified once.
+        campaign_id (Optional[str], optional): ID of the campaign. Defaults to a new campaign, see new_campaign_id.
+        concurrency (int, optional): Number of calls in flight at once. Defaults to 4.
+        calls_per_sec (Optional[float], optional): Max. number of calls per second. Defaults to notify_workers_calls_per_sec or 5.
+
+    Returns:
+        NotificationResult
+    """
+    if campaign_id is None:
+        campaign_id = new_campaign_id()
+    if calls_per_sec is None:
+        calls_per_sec = float(Config.get_or_default('notify_workers_calls_per_sec', 5))
+    rate_limiter = RateLimiter(calls_per_sec)
+    logging.info(f'Sending campaign {campaign_id} with subject "{subject}", pass this campaign ID to resume it if it is interrupted')
+
+    nr_skipped = 0
+    def unnotified_worker_ids() -> Iterable[str]:
+        nonlocal nr_skipped
+        for batch in chunked(dict.fromkeys(worker_ids), 1000):
+            notified_ids = repository.get_notified_worker_ids(campaign_id, batch)
+            nr_skipped += len(notified_ids)
+            yield from (worker_id for worker_id in batch if worker_id not in notified_ids)
+
+    def send(chunk: list[str]) -> list[dict]:
+        rate_limiter.wait()
+        return mturk_client.notify_workers(subject, message_text, chunk)
+
+    # Create the client before the threads do
+    mturk_client.Client.get()
+    nr_notified = nr_failed = 0
+    for chunk, future in run_bounded(send, chunked(unnotified_worker_ids(), mturk_client.NOTIFY_WORKERS_MAX_RECIPIENTS), concurrency):
+        if future.exception() is not None:
+            failure_statuses = [{
+                'WorkerId': worker_id,
+                'NotifyWorkersFailureCode': 'HardFailure' if not mturk_client.is_transient_error(future.exception()) else 'SoftFailure',
+                'NotifyWorkersFailureMessage': str(future.exception())
+            } for worker_id in chunk]
+        else:
+            failure_statuses = future.result()
+        repository.save_notification_results(campaign_id, chunk, failure_statuses)
+        nr_failed += len(failure_statuses)
+        nr_notified += len(chunk) - len(failure_statuses)
+        for status in failure_statuses:
+            logging.debug(f'Could not notify worker {status["WorkerId"]}: {status["NotifyWorkersFailureCode"]} "{status["NotifyWorkersFailureMessage"]}"')
+
+    result = NotificationResult(campaign_id, nr_notified, nr_skipped, nr_failed)
+    logging.info(f'Campaign {campaign_id}: {nr_notified} worker(s) notified, {nr_skipped} already notified before, {nr_failed} failed')
+    return result